@@ -0,0 +1,568 @@
+import importlib.util
+import json
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tabulate import tabulate
+
+from patchwork.logger import logger
+from patchwork.step import Step
+
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config, load_prompts  # noqa: E402
+
+_DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
+_DEFAULT_RESPONSES_JSON = Path(__file__).parent / "responses.json"
+_PATCHFLOWS_DIR = Path(__file__).resolve().parent.parent
+# The PR diffs of the PRReview case, read by the stand-in for ReadPRDiffs from the working directory of the run
+_PR_DIFFS_FILE = "pr_diffs.json"
+
+# Roughly 4 characters per token for English text and code, close enough to compare runs with each other
+_CHARS_PER_TOKEN = 4
+
+_POLYFILL_HTML = """<!DOCTYPE html>
+<html>
+  <head>
+    <title>Benchmark {index}</title>
+    <script src="https://polyfill.io/v3/polyfill.min.js?features=default,fetch"></script>
+    <script src="app.js"></script>
+  </head>
+  <body></body>
+</html>
+"""
+
+_PYTHON_MODULE = '''def add(a, b):
+    return a + b
+
+
+def scale(values, factor=2):
+    return [value * factor for value in values]
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def increment(self, step=1):
+        self.count += step
+        return self.count
+'''
+
+_SDK_INDEX = """export { useUser } from "./hooks";
+export { formatName, type NameParts } from "./format";
+"""
+
+_SDK_HOOKS = """export function useUser(options?: { or?: "redirect" | "throw" }): { id: string } | null {
+  return options ? { id: "1" } : null;
+}
+"""
+
+_SDK_FORMAT = """export type NameParts = { first: string; last?: string };
+
+export function formatName(parts: NameParts, upper = false): string {
+  const name = parts.last ? `${parts.first} ${parts.last}` : parts.first;
+  return upper ? name.toUpperCase() : name;
+}
+"""
+
+_DIFF = """@@ -1,3 +1,4 @@
+ def add(a, b):
+-    return a + b
++    total = a + b
++    return total
+"""
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // _CHARS_PER_TOKEN) if text else 0
+
+
+def _message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+class _StubLLMServer:
+    """Local OpenAI compatible chat completions endpoint that replays templated responses per prompt id."""
+
+    def __init__(self, responses: dict, fingerprints: list, latency_ms: float, jitter_ms: float,
+                 failure_rate: float, failure_status: int, seed: int):
+        self.responses = responses
+        self.fingerprints = fingerprints
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counter = 0
+        self.counters = {"requests": 0, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.requests_by_prompt = {}
+
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self._send(200, {"object": "list", "data": [{"id": "benchmark", "object": "model"}]})
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                status, response = stub.complete(body)
+                self._send(status, response)
+
+            def _send(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Stub LLM server: {format % args}")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+    def identify(self, messages: list) -> str:
+        text = "\n".join(_message_text(message) for message in messages)
+        for prompt_id, response in self.responses.items():
+            if "match" in response and response["match"] in text:
+                return prompt_id
+        # Longest static prefix first, so a more specific prompt wins over a shorter one
+        for prefix, prompt_id in self.fingerprints:
+            if any(_message_text(message).startswith(prefix) for message in messages):
+                return prompt_id
+        return "default"
+
+    def complete(self, body: dict) -> tuple:
+        messages = body.get("messages", [])
+        prompt_id = self.identify(messages)
+        with self._lock:
+            self._counter += 1
+            number = self._counter
+            latency = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            failed = self._random.random() < self.failure_rate
+            self.counters["requests"] += 1
+            self.requests_by_prompt[prompt_id] = self.requests_by_prompt.get(prompt_id, 0) + 1
+            if failed:
+                self.counters["failures"] += 1
+        time.sleep(latency / 1000)
+
+        if failed:
+            return self.failure_status, {"error": {"message": "Injected failure", "type": "server_error"}}
+
+        content = self.render(prompt_id, messages, number)
+        prompt_tokens = sum(_estimate_tokens(_message_text(message)) for message in messages)
+        completion_tokens = _estimate_tokens(content)
+        with self._lock:
+            self.counters["prompt_tokens"] += prompt_tokens
+            self.counters["completion_tokens"] += completion_tokens
+        return 200, {
+            "id": f"chatcmpl-benchmark-{number}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "benchmark"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def render(self, prompt_id: str, messages: list, number: int) -> str:
+        response = self.responses.get(prompt_id) or self.responses.get("default", {"content": ""})
+        content = response["content"].replace("{{n}}", str(number))
+        if "capture" not in response:
+            return content
+        # Groups of the capture pattern, matched against the last user message, fill {{1}}, {{2}}, ...
+        user_text = next((_message_text(m) for m in reversed(messages) if m.get("role") == "user"), "")
+        match = re.search(response["capture"], user_text, re.DOTALL)
+        groups = match.groups() if match is not None else ()
+        for index, group in enumerate(groups, start=1):
+            value = group or ""
+            if response.get("json_escape", False):
+                value = json.dumps(value)[1:-1]
+            content = content.replace(f"{{{{{index}}}}}", value)
+        return content
+
+
+def _prompt_fingerprints() -> list:
+    # The text before the first placeholder of every message identifies the prompt a request was rendered from
+    fingerprints = set()
+    for prompt_file in _PATCHFLOWS_DIR.glob("*/prompt.json"):
+        for prompt_id, prompt in load_prompts(prompt_file).items():
+            for message in prompt["prompts"]:
+                prefix = message.get("content", "").split("{{", 1)[0]
+                if len(prefix.strip()) >= 20:
+                    fingerprints.add((prefix, prompt_id))
+    return sorted(fingerprints, key=lambda fingerprint: len(fingerprint[0]), reverse=True)
+
+
+def _git_init(repo_path: Path):
+    for args in (
+        ["init", "-q"],
+        ["add", "-A"],
+        ["-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "commit", "-q", "-m", "Fixture"],
+    ):
+        subprocess.run(["git", *args], cwd=repo_path, check=True, capture_output=True)
+
+
+def _polyfill_repo(repo_path: Path, index: int) -> Path:
+    repo_path.mkdir(parents=True)
+    (repo_path / "index.html").write_text(_POLYFILL_HTML.format(index=index))
+    (repo_path / "app.js").write_text("document.addEventListener('DOMContentLoaded', () => fetch('/api'));\n")
+    _git_init(repo_path)
+    sarif = {
+        "version": "2.1.0",
+        "runs": [{
+            "tool": {"driver": {"name": "benchmark", "rules": [{"id": "polyfill-compromise"}]}},
+            "results": [{
+                "ruleId": "polyfill-compromise",
+                "level": "error",
+                "message": {"text": "polyfill.io serves malicious code, use the cdnjs mirror instead"},
+                "locations": [{
+                    "physicalLocation": {
+                        "artifactLocation": {"uri": "index.html"},
+                        "region": {"startLine": 5, "endLine": 5},
+                    }
+                }],
+            }],
+        }],
+    }
+    sarif_file = repo_path.parent / f"{repo_path.name}.sarif"
+    sarif_file.write_text(json.dumps(sarif))
+    return sarif_file
+
+
+def _python_repo(repo_path: Path, modules: int):
+    repo_path.mkdir(parents=True)
+    for index in range(modules):
+        (repo_path / f"module_{index}.py").write_text(_PYTHON_MODULE)
+    _git_init(repo_path)
+
+
+def _sdk_repo(repo_path: Path):
+    src = repo_path / "src"
+    src.mkdir(parents=True)
+    (src / "index.ts").write_text(_SDK_INDEX)
+    (src / "hooks.ts").write_text(_SDK_HOOKS)
+    (src / "format.ts").write_text(_SDK_FORMAT)
+    (repo_path / "docs").mkdir()
+    _git_init(repo_path)
+
+
+def _patchflow_defaults(name: str, base_url: str) -> dict:
+    # The same defaults the patchwork CLI reads from this folder with --config, pointed at the stub server
+    inputs = load_config(_PATCHFLOWS_DIR / name / "config.yml", {})
+    inputs.update({
+        "client_base_url": base_url,
+        "openai_api_key": "benchmark",
+        "disable_branch": True,
+        "disable_pr": True,
+    })
+    for key in ("patched_api_key", "google_api_key", "anthropic_api_key"):
+        inputs.pop(key, None)
+    if (_PATCHFLOWS_DIR / name / "prompt.json").is_file():
+        inputs["prompt_template_file"] = str(_PATCHFLOWS_DIR / name / "prompt.json")
+    return inputs
+
+
+def _load_custom_patchflow(name: str):
+    # Loaded the same way patchwork loads the custom patchflows of a config folder
+    spec = importlib.util.spec_from_file_location("custom_module", _PATCHFLOWS_DIR / name / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _prepare_autofix(work_dir: Path, base_url: str, size: int) -> list:
+    runs = []
+    for index in range(size):
+        repo_path = work_dir / f"autofix-{index}"
+        sarif_file = _polyfill_repo(repo_path, index)
+        inputs = _patchflow_defaults("AutoFix", base_url)
+        inputs["sarif_file_path"] = str(sarif_file)
+        runs.append({"cwd": str(repo_path), "inputs": inputs})
+    return runs
+
+
+def _run_autofix(inputs: dict):
+    from patchwork.patchflows import AutoFix
+
+    AutoFix(inputs).run()
+
+
+class _FixturePRDiffs:
+    """Stands in for ReadPRDiffs, returns the diffs _prepare_prreview wrote instead of reading a PR."""
+
+    def __init__(self, inputs: dict):
+        self.inputs = inputs
+
+    def run(self) -> dict:
+        return {"prompt_values": json.loads(Path(_PR_DIFFS_FILE).read_text())}
+
+
+class _DiscardedPRComment:
+    """Stands in for CreatePRComment, the comment is dropped instead of posted."""
+
+    def __init__(self, inputs: dict):
+        self.inputs = inputs
+
+    def run(self) -> dict:
+        return {}
+
+
+def _prepare_prreview(work_dir: Path, base_url: str, size: int) -> list:
+    # Reading the PR and posting the comment need the SCM API, everything between them is measured
+    inputs = _patchflow_defaults("PRReview", base_url)
+    inputs["map_reduce"] = True
+    # A long summary, so the reduce stage is measured as well
+    inputs["diff_summary"] = "long"
+    work_dir.joinpath("prreview").mkdir()
+    work_dir.joinpath("prreview", _PR_DIFFS_FILE).write_text(json.dumps([
+        {"title": "Benchmark", "body": "", "path": f"module_{index}.py", "diff": _DIFF} for index in range(size)
+    ]))
+    return [{"cwd": str(work_dir / "prreview"), "inputs": inputs}]
+
+
+def _run_prreview(inputs: dict):
+    prreview = _load_custom_patchflow("PRReview")
+    prreview.ReadPRDiffs = _FixturePRDiffs
+    prreview.CreatePRComment = _DiscardedPRComment
+    prreview.PRReview(inputs).run()
+
+
+def _prepare_generate_docstring(work_dir: Path, base_url: str, size: int) -> list:
+    repo_path = work_dir / "docstring"
+    _python_repo(repo_path, size)
+    inputs = _patchflow_defaults("GenerateDocstring", base_url)
+    inputs["base_path"] = str(repo_path)
+    # The per file batches of this folder's GenerateDocstring, not one request per function
+    inputs["batched"] = True
+    return [{"cwd": str(repo_path), "inputs": inputs}]
+
+
+def _run_generate_docstring(inputs: dict):
+    _load_custom_patchflow("GenerateDocstring").GenerateDocstring(inputs).run()
+
+
+def _prepare_update_sdk_docs(work_dir: Path, base_url: str, size: int) -> list:
+    runs = []
+    for index in range(size):
+        repo_path = work_dir / f"sdk-{index}"
+        _sdk_repo(repo_path)
+        inputs = _patchflow_defaults("UpdateSDKDocs", base_url)
+        inputs.update({
+            "sdk_src_folder": str(repo_path / "src"),
+            "sdk_docs_folder": str(repo_path / "docs"),
+            "model": "benchmark",
+        })
+        runs.append({"cwd": str(repo_path), "inputs": inputs})
+    return runs
+
+
+def _run_update_sdk_docs(inputs: dict):
+    _load_custom_patchflow("UpdateSDKDocs").UpdateSDKDocs(inputs).run()
+
+
+def _prepare_fixpolyfill(work_dir: Path, base_url: str, size: int) -> list:
+    # Listing an org needs the SCM API, so the per repo fix of Fixpolyfill runs on local fixture repos
+    runs = []
+    for index in range(size):
+        repo_path = work_dir / f"fixpolyfill-{index}"
+        sarif_file = _polyfill_repo(repo_path, index)
+        inputs = _patchflow_defaults("Fixpolyfill", base_url)
+        inputs["sarif_file_path"] = str(sarif_file)
+        inputs["model"] = "benchmark"
+        runs.append({"cwd": str(repo_path), "inputs": inputs})
+    return runs
+
+
+def _run_fixpolyfill(inputs: dict):
+    fixpolyfill = _load_custom_patchflow("Fixpolyfill")
+    fixpolyfill._fix_repo(inputs, fixpolyfill.Tracer())
+
+
+_CASES = {
+    "AutoFix": (_prepare_autofix, _run_autofix),
+    "PRReview": (_prepare_prreview, _run_prreview),
+    "GenerateDocstring": (_prepare_generate_docstring, _run_generate_docstring),
+    "UpdateSDKDocs": (_prepare_update_sdk_docs, _run_update_sdk_docs),
+    "Fixpolyfill": (_prepare_fixpolyfill, _run_fixpolyfill),
+}
+
+
+def _run_in_worker(case: str, run: dict, work_dir: Path, label: str) -> dict:
+    # Every run gets its own process, so cwd changes stay contained and the peak RSS belongs to that run alone
+    inputs_file = work_dir / f"{label}.inputs.json"
+    outputs_file = work_dir / f"{label}.outputs.json"
+    inputs_file.write_text(json.dumps({"case": case, "inputs": run["inputs"]}, default=str))
+    subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), str(inputs_file), str(outputs_file)],
+        cwd=run["cwd"],
+        check=False,
+    )
+    if not outputs_file.is_file():
+        return {"error": "worker exited without a result"}
+    return json.loads(outputs_file.read_text())
+
+
+class Benchmark(Step):
+    def __init__(self, inputs: dict):
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
+
+        if "responses_file" not in final_inputs:
+            final_inputs["responses_file"] = _DEFAULT_RESPONSES_JSON
+
+        cases = final_inputs.get("cases", list(_CASES))
+        if isinstance(cases, str):
+            cases = [case.strip() for case in cases.split(",") if case.strip()]
+        unknown_cases = [case for case in cases if case not in _CASES]
+        if unknown_cases:
+            raise ValueError(f"Unknown benchmark cases {unknown_cases}, expected some of {list(_CASES)}")
+
+        self.cases = cases
+        self.inputs = final_inputs
+
+    def run(self) -> dict:
+        server = _StubLLMServer(
+            json.loads(Path(self.inputs["responses_file"]).read_text()),
+            _prompt_fingerprints(),
+            latency_ms=float(self.inputs.get("stub_latency_ms", 0)),
+            jitter_ms=float(self.inputs.get("stub_latency_jitter_ms", 0)),
+            failure_rate=float(self.inputs.get("stub_failure_rate", 0)),
+            failure_status=int(self.inputs.get("stub_failure_status", 500)),
+            seed=int(self.inputs.get("seed", 0)),
+        )
+        server.start()
+        logger.info(f"Stub LLM server listening on {server.base_url}")
+
+        repeats = int(self.inputs.get("repeats", 3))
+        size = int(self.inputs.get("fixture_size", 3))
+        results = []
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for case in self.cases:
+                    results.append(self._run_case(case, server, Path(tmp_dir), repeats, size))
+        finally:
+            server.stop()
+
+        self.print_summary(results, server)
+        if "benchmark_output" in self.inputs:
+            Path(self.inputs["benchmark_output"]).write_text(json.dumps(results, indent=2))
+        if "benchmark_baseline" in self.inputs:
+            self.compare_with_baseline(results)
+
+        self.inputs["benchmark_results"] = results
+        return self.inputs
+
+    def _run_case(self, case: str, server: _StubLLMServer, tmp_dir: Path, repeats: int, size: int) -> dict:
+        prepare, _ = _CASES[case]
+        wall_times, cpu_times, peak_rss, errors = [], [], 0, []
+        before = server.snapshot()
+        for repeat in range(repeats):
+            # Fresh fixtures for every repeat, since the patchflows modify the repos they run on
+            work_dir = tmp_dir / f"{case}-{repeat}"
+            work_dir.mkdir()
+            runs = prepare(work_dir, server.base_url, size)
+            start = time.perf_counter()
+            cpu_time = 0.0
+            for index, run in enumerate(runs):
+                outputs = _run_in_worker(case, run, work_dir, f"run-{index}")
+                cpu_time += outputs.get("cpu_time", 0.0)
+                peak_rss = max(peak_rss, outputs.get("peak_rss_kb", 0))
+                if "error" in outputs:
+                    errors.append(outputs["error"])
+            wall_times.append(time.perf_counter() - start)
+            cpu_times.append(cpu_time)
+        after = server.snapshot()
+
+        if errors:
+            logger.warning(f"{case} failed in {len(errors)} runs, first error: {errors[0]}")
+        return {
+            "case": case,
+            "wall_time_s": round(statistics.median(wall_times), 3),
+            "cpu_time_s": round(statistics.median(cpu_times), 3),
+            "requests": (after["requests"] - before["requests"]) // repeats,
+            "failures_injected": (after["failures"] - before["failures"]) // repeats,
+            "prompt_tokens": (after["prompt_tokens"] - before["prompt_tokens"]) // repeats,
+            "completion_tokens": (after["completion_tokens"] - before["completion_tokens"]) // repeats,
+            "peak_rss_mb": round(peak_rss / 1024, 1),
+            "errors": len(errors),
+        }
+
+    def print_summary(self, results: list, server: _StubLLMServer):
+        print("\nBenchmark results, medians per repeat, tokens are estimated by the stub server:")
+        print(tabulate(results, headers="keys", tablefmt="grid"))
+        print(tabulate(sorted(server.requests_by_prompt.items()), headers=["prompt id", "requests"], tablefmt="grid"))
+
+    def compare_with_baseline(self, results: list):
+        baseline = {result["case"]: result for result in json.loads(Path(self.inputs["benchmark_baseline"]).read_text())}
+        max_regression = float(self.inputs.get("max_regression", 0.2))
+        regressions = []
+        for result in results:
+            previous = baseline.get(result["case"])
+            if previous is None:
+                continue
+            for metric in ("wall_time_s", "requests", "prompt_tokens", "peak_rss_mb"):
+                if previous[metric] and result[metric] > previous[metric] * (1 + max_regression):
+                    regressions.append(f"{result['case']} {metric}: {previous[metric]} -> {result[metric]}")
+        if regressions:
+            raise RuntimeError("Benchmark regressions over the baseline:\n" + "\n".join(regressions))
+        print(f"No regressions over {max_regression:.0%} compared to {self.inputs['benchmark_baseline']}")
+
+
+if __name__ == "__main__":
+    # Worker entrypoint used by _run_in_worker, runs one benchmark case in the cwd
+    worker_request = json.loads(Path(sys.argv[1]).read_text())
+    worker_outputs = {}
+    cpu_start = time.process_time()
+    try:
+        _CASES[worker_request["case"]][1](worker_request["inputs"])
+    except Exception as e:
+        worker_outputs["error"] = f"{type(e).__name__}: {e}"
+    worker_outputs["cpu_time"] = time.process_time() - cpu_start
+    # ru_maxrss is reported in kilobytes on Linux
+    worker_outputs["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    Path(sys.argv[2]).write_text(json.dumps(worker_outputs))
@@ -1,7 +1,22 @@
 import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from importlib import metadata
+from itertools import islice
 from pathlib import Path
+from typing import Optional
 
-import yaml
+from tabulate import tabulate
 
 from patchwork.common.utils.progress_bar import PatchflowProgressBar
 from patchwork.common.utils.step_typing import validate_steps_with_inputs
@@ -9,69 +24,569 @@ from patchwork.logger import logger
 from patchwork.step import Step
 from patchwork.steps import ScanDepscan
 
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config  # noqa: E402
+
 
 
 _DEFAULT_INPUT_FILE = Path(__file__).parent / "defaults.yml"
 
+_FIELDNAMES = ["coordinate", "version", "license", "indirect"]
+
+# Manifests and lockfiles that mark a project root, mapped to the depscan language that scans it
+_MANIFEST_LANGUAGES = {
+    "go.mod": "go",
+    "package.json": "js",
+    "package-lock.json": "js",
+    "yarn.lock": "js",
+    "pnpm-lock.yaml": "js",
+    "requirements.txt": "python",
+    "pyproject.toml": "python",
+    "Pipfile.lock": "python",
+    "poetry.lock": "python",
+    "pom.xml": "java",
+    "build.gradle": "java",
+    "build.gradle.kts": "java",
+}
+
+_DISCOVERY_SKIP_DIRS = {"node_modules", "vendor", "venv", "__pycache__", "build", "dist", "target"}
+
+# Files whose content decides the dependencies a scan finds, hashed into the SBOM cache key
+_LOCKFILE_NAMES = set(_MANIFEST_LANGUAGES) | {
+    "go.sum",
+    "npm-shrinkwrap.json",
+    "Pipfile",
+    "setup.py",
+    "setup.cfg",
+    "gradle.lockfile",
+    "settings.gradle",
+    "settings.gradle.kts",
+}
+
+
+def _iter_sbom_components(sbom_file_path: str):
+    # ijson parses the file incrementally, so only one component is held in memory at a time
+    try:
+        import ijson
+    except ImportError:
+        logger.warning("ijson is not installed, loading the whole SBOM file into memory")
+        with open(sbom_file_path, "r") as f:
+            yield from json.load(f).get("components", [])
+        return
+
+    with open(sbom_file_path, "rb") as f:
+        yield from ijson.items(f, "components.item")
+
+
+def _component_rows(components):
+    for component in components:
+        coordinate = component.get("bom-ref")
+        version = component.get("version", "None")
+        # One pass over the properties, every lookup after that is a dict access
+        properties = {
+            property.get("name"): property.get("value")
+            for property in component.get("properties", [])
+        }
+        indirect = properties.get("cdx:go:indirect", "Unknown")
+
+        licenses = component.get("licenses", [])
+        if len(licenses) < 1:
+            yield {
+                "coordinate": coordinate,
+                "version": version,
+                "license": "Unknown",
+                "indirect": indirect,
+            }
+            continue
+
+        for component_license in licenses:
+            maybe_license = component_license.get("license", {}).get("id", "Unknown")
+            yield {
+                "coordinate": coordinate,
+                "version": version,
+                "license": maybe_license,
+                "indirect": indirect,
+            }
+
+
+def _walk_project(root: Path):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames
+            if dirname not in _DISCOVERY_SKIP_DIRS and not dirname.startswith(".")
+        )
+        yield dirpath, dirnames, filenames
+
+
+def _discover_projects(root: Path) -> list:
+    projects = []
+    # Walked in sorted order so the projects, and with them the deduplication winners, are the same on every run
+    for dirpath, dirnames, filenames in _walk_project(root):
+        languages = sorted({_MANIFEST_LANGUAGES[filename] for filename in filenames if filename in _MANIFEST_LANGUAGES})
+        project = Path(dirpath).relative_to(root).as_posix()
+        projects.extend((project, language) for language in languages)
+    return projects
+
+
+def _scan_in_subprocess(inputs: dict, project_path: Path, work_dir: Path, index: int) -> Optional[Path]:
+    # ScanDepscan scans the cwd, so every project is scanned by its own process started in the project folder
+    inputs_file = work_dir / f"{index}.inputs.json"
+    sbom_file = work_dir / f"{index}.sbom.json"
+    inputs_file.write_text(json.dumps(inputs, default=str))
+
+    try:
+        subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), str(inputs_file), str(sbom_file)],
+            cwd=project_path,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Scanning {project_path} for {inputs.get('language')} failed: {e}")
+        return None
+    return sbom_file
+
+
+def _scanner_version() -> str:
+    try:
+        depscan_version = metadata.version("owasp-depscan")
+    except metadata.PackageNotFoundError:
+        depscan_version = "unknown"
+    try:
+        cdxgen_version = subprocess.run(
+            ["cdxgen", "--version"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        cdxgen_version = "unknown"
+    return f"depscan {depscan_version}, cdxgen {cdxgen_version}"
+
+
+class _SbomCache:
+    """SBOMs stored by the hash of the lockfiles and manifests they were scanned from, evicted least recently used first."""
+
+    def __init__(self, cache_dir: str, max_size_mb: int, refresh: bool):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.refresh = refresh
+        self.scanner_version = _scanner_version()
+
+    def key(self, project_path: Path, inputs: dict) -> str:
+        digest = hashlib.sha256()
+        options = {
+            "scanner": self.scanner_version,
+            "language": inputs.get("language"),
+            "license": inputs.get("license"),
+        }
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        for dirpath, _, filenames in _walk_project(project_path):
+            for filename in sorted(filenames):
+                if filename not in _LOCKFILE_NAMES:
+                    continue
+                file_path = Path(dirpath) / filename
+                digest.update(file_path.relative_to(project_path).as_posix().encode() + b"\0")
+                digest.update(hashlib.sha256(file_path.read_bytes()).digest())
+        return digest.hexdigest()
+
+    def lookup(self, key: str) -> Optional[Path]:
+        sbom_file = self.cache_dir / f"{key}.json"
+        if self.refresh or not sbom_file.is_file():
+            return None
+        # The mtime marks the last use for eviction
+        sbom_file.touch()
+        return sbom_file
+
+    def store(self, key: str, sbom_file: Path) -> Path:
+        cached_file = self.cache_dir / f"{key}.json"
+        tmp_file = cached_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(sbom_file, tmp_file)
+        os.replace(tmp_file, cached_file)
+        return cached_file
+
+    def store_values(self, key: str, sbom_values: dict) -> None:
+        cached_file = self.cache_dir / f"{key}.json"
+        tmp_file = cached_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_file.write_text(json.dumps(sbom_values))
+        os.replace(tmp_file, cached_file)
+
+    def evict(self) -> None:
+        entries = sorted(self.cache_dir.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        total_size = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total_size <= self.max_size:
+                break
+            total_size -= path.stat().st_size
+            path.unlink()
+            logger.info(f"Evicted cached SBOM {path.name}")
+
+
+def _unique_components(components, seen_refs: set):
+    for component in components:
+        bom_ref = component.get("bom-ref")
+        if bom_ref is not None:
+            if bom_ref in seen_refs:
+                continue
+            seen_refs.add(bom_ref)
+        yield component
+
+
+def _project_rows(scans: list):
+    seen_refs = set()
+    for project, sbom_file in scans:
+        components = _unique_components(_iter_sbom_components(sbom_file), seen_refs)
+        for row in _component_rows(components):
+            row["project"] = project
+            yield row
+
+
+def _batched(rows, batch_size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class _CsvReportWriter:
+    def __init__(self, output_path: str, fieldnames: list):
+        self._file = open(output_path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=fieldnames)
+        self._writer.writeheader()
+
+    def write_batch(self, rows: list):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _JsonlReportWriter:
+    def __init__(self, output_path: str, fieldnames: list):
+        self._file = open(output_path, "w")
+
+    def write_batch(self, rows: list):
+        self._file.write("".join(json.dumps(row) + "\n" for row in rows))
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetReportWriter:
+    def __init__(self, output_path: str, fieldnames: list):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ValueError("output_format 'parquet' requires pyarrow to be installed") from e
+
+        self._pa = pa
+        self._fieldnames = fieldnames
+        self._schema = pa.schema([(fieldname, pa.string()) for fieldname in fieldnames])
+        self._writer = pq.ParquetWriter(output_path, self._schema)
+
+    def write_batch(self, rows: list):
+        # Every batch becomes one row group of the parquet file
+        columns = {
+            fieldname: [None if row[fieldname] is None else str(row[fieldname]) for row in rows]
+            for fieldname in self._fieldnames
+        }
+        self._writer.write_table(self._pa.table(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+_INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    commit_sha TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS components (
+    repo TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    project TEXT NOT NULL,
+    coordinate TEXT,
+    package TEXT,
+    version TEXT,
+    license TEXT,
+    indirect TEXT
+);
+CREATE INDEX IF NOT EXISTS components_repo_commit ON components (repo, commit_sha);
+CREATE INDEX IF NOT EXISTS components_coordinate ON components (coordinate);
+CREATE INDEX IF NOT EXISTS components_package_version ON components (package, version);
+CREATE INDEX IF NOT EXISTS components_license ON components (license);
+"""
+
+_RELEASE_PATTERN = re.compile(r"v?(\d+(?:\.\d+)*)")
+
+
+def _package_of(coordinate: Optional[str]) -> Optional[str]:
+    # pkg:golang/github.com/x/y@v1.2.3?type=module -> pkg:golang/github.com/x/y, purls encode other @ as %40
+    if coordinate is None:
+        return None
+    return coordinate.split("?", 1)[0].rsplit("@", 1)[0]
+
+
+def _release_of(version: Optional[str]) -> Optional[tuple]:
+    match = _RELEASE_PATTERN.match(version or "")
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.group(1).split("."))
+
+
+def _version_below(version: Optional[str], bound: str) -> bool:
+    # Compares the numeric release part only, versions without one never match
+    release = _release_of(version)
+    bound_release = _release_of(bound)
+    if release is None or bound_release is None:
+        return False
+    width = max(len(release), len(bound_release))
+    return release + (0,) * (width - len(release)) < bound_release + (0,) * (width - len(bound_release))
+
+
+def _git_output(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip() or None
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+class _Inventory:
+    """SQLite store of the components of every repo, holding the rows of its last reported commit."""
+
+    def __init__(self, db_path: str):
+        self.db_path = Path(db_path).expanduser()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Many repos may report into the same file, WAL lets readers work while one of them writes
+        self._connection = sqlite3.connect(self.db_path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_INVENTORY_SCHEMA)
+        self._connection.create_function("version_below", 2, _version_below, deterministic=True)
+
+    def begin_repo(self, repo: str, commit_sha: str):
+        # Everything up to finish_repo is one transaction, so queries never see a half written repo
+        self._repo = repo
+        self._commit_sha = commit_sha
+        self._connection.execute("DELETE FROM components WHERE repo = ?", (repo,))
+
+    def add_rows(self, rows: list):
+        self._connection.executemany(
+            "INSERT INTO components VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    self._repo,
+                    self._commit_sha,
+                    row.get("project", "."),
+                    row["coordinate"],
+                    _package_of(row["coordinate"]),
+                    row["version"],
+                    row["license"],
+                    row["indirect"],
+                )
+                for row in rows
+            ],
+        )
+
+    def finish_repo(self):
+        self._connection.execute(
+            "INSERT INTO repos VALUES (?, ?, ?) "
+            "ON CONFLICT (repo) DO UPDATE SET commit_sha = excluded.commit_sha, updated_at = excluded.updated_at",
+            (self._repo, self._commit_sha, datetime.now(timezone.utc).isoformat()),
+        )
+        self._connection.commit()
+
+    def query(self, package: Optional[str], version_below: Optional[str], license: Optional[str], repo: Optional[str]) -> list:
+        conditions = []
+        parameters = []
+        if package is not None:
+            conditions.append("package LIKE ?" if "%" in package else "package = ?")
+            parameters.append(package)
+        if version_below is not None:
+            conditions.append("version_below(version, ?)")
+            parameters.append(version_below)
+        if license is not None:
+            conditions.append("license = ?")
+            parameters.append(license)
+        if repo is not None:
+            conditions.append("repo = ?")
+            parameters.append(repo)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        cursor = self._connection.execute(
+            "SELECT DISTINCT repo, commit_sha, project, coordinate, version, license "
+            f"FROM components {where} ORDER BY repo, project, coordinate",
+            parameters,
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, values)) for values in cursor.fetchall()]
+
+    def close(self):
+        self._connection.close()
+
+
+_REPORT_WRITERS = {
+    "csv": _CsvReportWriter,
+    "jsonl": _JsonlReportWriter,
+    "parquet": _ParquetReportWriter,
+}
+
 
 class DependencyReport(Step):
     def __init__(self, inputs: dict):
         PatchflowProgressBar(self).register_steps(ScanDepscan)
 
-        final_inputs = yaml.safe_load(_DEFAULT_INPUT_FILE.read_text())
-        final_inputs.update(inputs)
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
 
-        validate_steps_with_inputs(
-            set(final_inputs.keys()),
-            ScanDepscan
-        )
+        if final_inputs.get("output_format", "csv") not in _REPORT_WRITERS:
+            raise ValueError(
+                f"Unknown output_format '{final_inputs['output_format']}', expected one of {list(_REPORT_WRITERS)}"
+            )
+
+        if final_inputs.get("inventory_query", False) and "inventory_db" not in final_inputs:
+            raise ValueError("inventory_query requires inventory_db, the path of the inventory to query")
+
+        if "sbom_file_path" not in final_inputs:
+            validate_steps_with_inputs(
+                set(final_inputs.keys()),
+                ScanDepscan
+            )
 
         self.inputs = final_inputs
 
+        self.sbom_cache = None
+        if "sbom_cache_dir" in final_inputs:
+            self.sbom_cache = _SbomCache(
+                final_inputs["sbom_cache_dir"],
+                int(final_inputs.get("sbom_cache_max_size_mb", 512)),
+                bool(final_inputs.get("sbom_cache_refresh", False)),
+            )
+
     def run(self) -> dict:
+        if self.inputs.get("inventory_query", False):
+            return self._query_inventory()
+
+        if self.inputs.get("discover_projects", False):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                scans = self._scan_projects(Path(tmp_dir))
+                self._write_report(_project_rows(scans), _FIELDNAMES + ["project"])
+        else:
+            self._write_report(_component_rows(self._components()), _FIELDNAMES)
+
+        # Evicted only after the report is written, so no SBOM being read is removed
+        if self.sbom_cache is not None:
+            self.sbom_cache.evict()
+        return self.inputs
+
+    def _components(self):
+        sbom_file_path = self.inputs.get("sbom_file_path")
+        cache_key = None
+        if sbom_file_path is None and self.sbom_cache is not None:
+            cache_key = self.sbom_cache.key(Path.cwd(), self.inputs)
+            sbom_file_path = self.sbom_cache.lookup(cache_key)
+            if sbom_file_path is not None:
+                logger.info(f"Lockfiles are unchanged, reusing the cached SBOM {sbom_file_path}")
+
+        if sbom_file_path is not None:
+            logger.info(f"Reading components from {sbom_file_path}")
+            return _iter_sbom_components(sbom_file_path)
+
         outputs = ScanDepscan(self.inputs).run()
         self.inputs.update(outputs)
-        sbom_values = self.inputs.get("sbom_vdr_values")
+        if cache_key is not None:
+            self.sbom_cache.store_values(cache_key, outputs["sbom_vdr_values"])
+        return self.inputs.get("sbom_vdr_values").get("components", [])
+
+    def _scan_projects(self, work_dir: Path) -> list:
+        root = Path.cwd()
+        projects = _discover_projects(root)
+        logger.info(f"Found {len(projects)} projects to scan: {projects}")
+
+        sbom_files = [None] * len(projects)
+        cache_keys = [None] * len(projects)
+        for index, (project, language) in enumerate(projects):
+            if self.sbom_cache is None:
+                continue
+            cache_keys[index] = self.sbom_cache.key(root / project, {**self.inputs, "language": language})
+            sbom_files[index] = self.sbom_cache.lookup(cache_keys[index])
+        missing = [index for index, sbom_file in enumerate(sbom_files) if sbom_file is None]
+        logger.info(f"{len(projects) - len(missing)} projects reuse a cached SBOM, {len(missing)} are scanned")
+
+        if missing:
+            # Installs cdxgen once here, instead of racing installs in every scan process
+            ScanDepscan(self.inputs)
+
+        def scan(index):
+            project, language = projects[index]
+            inputs = dict(self.inputs)
+            inputs["language"] = language
+            sbom_file = _scan_in_subprocess(inputs, root / project, work_dir, index)
+            if sbom_file is not None and cache_keys[index] is not None:
+                self.sbom_cache.store(cache_keys[index], sbom_file)
+            return sbom_file
+
+        max_parallel_scans = int(self.inputs.get("max_parallel_scans", os.cpu_count() or 1))
+        with ThreadPoolExecutor(max_workers=max_parallel_scans) as executor:
+            for index, sbom_file in zip(missing, executor.map(scan, missing)):
+                sbom_files[index] = sbom_file
+        # Kept in the order of the projects, so the first project listing a component owns its row
+        return [
+            (project, sbom_file)
+            for (project, _), sbom_file in zip(projects, sbom_files)
+            if sbom_file is not None
+        ]
+
+    def _write_report(self, rows, fieldnames: list):
         output_path = self.inputs.get("output_path")
+        output_format = self.inputs.get("output_format", "csv")
+        batch_size = int(self.inputs.get("output_batch_size", 1000))
 
-        logger.info(f"Report is being written to {output_path}")
-        with open(output_path, "w", newline="") as csvfile:
-            fieldnames = ["coordinate", "version", "license", "indirect"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for component in sbom_values.get("components", []):
-                coordinate = component.get("bom-ref")
-                version = component.get("version", "None")
-                properties = component.get("properties", [])
-                indirect = "Unknown"
-                is_image = False
-
-                for property in properties:
-                    if property.get("name") == "cdx:go:indirect":
-                        indirect = property.get("value")
-
-                    if property.get("name") == "oci:SrcImage":
-                        is_image = True
-
-                licenses = component.get("licenses", [])
-                if len(licenses) < 1:
-                    writer.writerow({
-                        "coordinate": coordinate,
-                        "version": version,
-                        "license": "Unknown",
-                        "indirect": indirect,
-                    })
-                    continue
+        inventory = None
+        if "inventory_db" in self.inputs:
+            repo = self.inputs.get("inventory_repo") or _git_output("config", "--get", "remote.origin.url") or Path.cwd().name
+            commit_sha = self.inputs.get("inventory_commit") or _git_output("rev-parse", "HEAD") or "unknown"
+            inventory = _Inventory(self.inputs["inventory_db"])
+            inventory.begin_repo(repo, commit_sha)
 
-                for component_license in component.get("licenses", []):
-                    maybe_license = component_license.get("license", {}).get("id", "Unknown")
-                    writer.writerow({
-                        "coordinate": coordinate,
-                        "version": version,
-                        "license": maybe_license,
-                        "indirect": indirect,
-                    })
+        logger.info(f"Report is being written to {output_path}")
+        writer = _REPORT_WRITERS[output_format](output_path, fieldnames)
+        try:
+            for batch in _batched(rows, batch_size):
+                writer.write_batch(batch)
+                if inventory is not None:
+                    inventory.add_rows(batch)
+            if inventory is not None:
+                inventory.finish_repo()
+                logger.info(f"Inventory {self.inputs['inventory_db']} updated for {repo} at {commit_sha}")
+        finally:
+            writer.close()
+            if inventory is not None:
+                # Closing without finish_repo rolls the repo back to its previous rows
+                inventory.close()
 
         logger.info(f"Report written to {output_path}")
+
+    def _query_inventory(self) -> dict:
+        inventory = _Inventory(self.inputs["inventory_db"])
+        try:
+            results = inventory.query(
+                self.inputs.get("query_package"),
+                self.inputs.get("query_version_below"),
+                self.inputs.get("query_license"),
+                self.inputs.get("query_repo"),
+            )
+        finally:
+            inventory.close()
+
+        print(tabulate(results, headers="keys", tablefmt="grid"))
+        print(f"{len(results)} components in {len({result['repo'] for result in results})} repositories")
+        self.inputs["inventory_results"] = results
         return self.inputs
+
+
+if __name__ == "__main__":
+    # Worker entrypoint used by _scan_in_subprocess, scans the project in the cwd
+    worker_inputs = json.loads(Path(sys.argv[1]).read_text())
+    worker_outputs = ScanDepscan(worker_inputs).run()
+    Path(sys.argv[2]).write_text(json.dumps(worker_outputs["sbom_vdr_values"]))
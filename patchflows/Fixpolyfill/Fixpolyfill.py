@@ -1,33 +1,640 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-import yaml
 import tempfile
 import os
+import json
+import hashlib
+import math
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterable, Iterator, Optional
+from urllib.parse import unquote, urlparse
 from tabulate import tabulate
 
-from github import Github, GithubException
+import requests
+from requests.adapters import HTTPAdapter
+from github import Github, GithubException, GithubRetry
 from gitlab import Gitlab
 from gitlab.exceptions import GitlabAuthenticationError, GitlabGetError
 
 from patchwork.logger import logger
 from patchwork.step import Step
 from patchwork.patchflows import AutoFix
+from patchwork.patchflows.AutoFix.AutoFix import Compatibility
+from patchwork.steps import LLM, PR, ExtractCode, ModifyCode, ScanSemgrep
+
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config, load_prompts  # noqa: E402
+from patchflow_tracing import Tracer  # noqa: E402
 
 _DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
 _DEFAULT_PROMPT_JSON = Path(__file__).parent / "prompt.json"
+_DEFAULT_REPO_CACHE_MAX_SIZE_MB = 10240
+_DEFAULT_API_POOL_SIZE = 10
+# Well below the GitHub secondary rate limit of 80 content creating requests per minute
+_DEFAULT_API_MAX_FIXES_PER_MINUTE = 30
+# Requests kept in reserve for the PR steps of the repos still being fixed
+_DEFAULT_API_RATE_LIMIT_RESERVE = 100
+_RATE_LIMIT_RETRIES = 5
+# Responses kept for conditional requests, listing an org touches every page once so the cache must not grow with it
+_ETAG_CACHE_MAX_ENTRIES = 256
+
+# Domains taken over in the polyfill.io supply chain attack, see README.md
+_POLYFILL_HOSTS = (
+    "polyfill.io",
+    "bootcdn.net",
+    "bootcss.com",
+    "staticfile.net",
+    "staticfile.org",
+    "unionadjs.com",
+    "xhsbpza.com",
+    "union.macoms.la",
+    "newcrbpc.com",
+)
+_POLYFILL_URL_PATTERN = re.compile(
+    r"(?P<scheme>(?:https?:)?//)(?P<host>(?:[\w-]+\.)*(?:"
+    + "|".join(re.escape(host) for host in _POLYFILL_HOSTS)
+    + r"))(?![\w-]|\.\w)(?P<path>/[^\s\"'<>`)]*)?",
+    re.IGNORECASE,
+)
+# (host, path prefix, cdnjs path prefix), URLs that match none of these are left to the LLM
+_POLYFILL_REWRITES = (
+    (re.compile(r"(?:cdn\.)?polyfill\.io", re.IGNORECASE), "/v3/", "/polyfill/v3/"),
+    (re.compile(r"cdn\.(?:bootcdn\.net|bootcss\.com)", re.IGNORECASE), "/ajax/libs/", "/ajax/libs/"),
+    (re.compile(r"cdn\.(?:bootcss\.com|staticfile\.net|staticfile\.org)", re.IGNORECASE), "/", "/ajax/libs/"),
+)
+_POLYFILL_SCAN_EXTENSIONS = {
+    ".html", ".htm", ".xhtml", ".js", ".mjs", ".cjs", ".jsx", ".ts", ".tsx", ".vue", ".svelte", ".astro",
+    ".php", ".erb", ".ejs", ".hbs", ".handlebars", ".mustache", ".njk", ".jinja", ".jinja2", ".j2",
+    ".twig", ".liquid", ".tpl", ".jsp", ".cshtml", ".aspx",
+}
+_POLYFILL_SKIP_DIRS = {".git", "node_modules"}
+# GitHub code search stops returning results past this point, so the candidate list would be incomplete
+_GITHUB_CODE_SEARCH_LIMIT = 1000
+_TRIAGED_OUT = "Skipped: no polyfill references found"
+
+
+class _TokenBucket:
+    """Thread safe token bucket whose rate follows the rate limit headers of the API responses."""
+
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                wait = self._paused_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                if wait <= 0:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause_until(self, reset_at: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + max(reset_at - time.time(), 0))
+
+    def update(self, remaining: int, reset_at: float) -> None:
+        if remaining <= 0:
+            self.pause_until(reset_at)
+            return
+        # Spread what is left of the window evenly so throughput stays near the allowed ceiling
+        with self._lock:
+            self.rate = remaining / max(reset_at - time.time(), 1)
+
+
+class _RateLimitedAdapter(HTTPAdapter):
+    """
+    Pooled adapter that schedules requests through a _TokenBucket, backs off on rate limit responses
+    and answers repeated GET requests from an ETag cache with conditional requests.
+    """
+
+    def __init__(self, bucket: _TokenBucket, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self._etag_cache = OrderedDict()
+        self._etag_cache_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        cacheable = request.method == "GET" and not kwargs.get("stream")
+        cached = self._cached_response(request.url) if cacheable else None
+        if cached is not None:
+            request.headers["If-None-Match"] = cached.headers["ETag"]
+
+        for attempt in range(_RATE_LIMIT_RETRIES + 1):
+            self.bucket.acquire()
+            response = super().send(request, **kwargs)
+            self._update_bucket(response)
+            if attempt == _RATE_LIMIT_RETRIES or not self._is_rate_limited(response):
+                break
+            self.bucket.pause_until(time.time() + _retry_after_seconds(response.headers.get("Retry-After"), 2 ** attempt))
+            response.close()
+
+        if response.status_code == 304 and cached is not None:
+            return cached
+        if cacheable and response.status_code == 200 and "ETag" in response.headers:
+            response.content  # Read the body now so the response can be served again
+            self._cache_response(request.url, response)
+        return response
+
+    def _cached_response(self, url: str):
+        with self._etag_cache_lock:
+            cached = self._etag_cache.get(url)
+            if cached is not None:
+                self._etag_cache.move_to_end(url)
+            return cached
+
+    def _cache_response(self, url: str, response) -> None:
+        with self._etag_cache_lock:
+            self._etag_cache[url] = response
+            self._etag_cache.move_to_end(url)
+            # Least recently used first
+            while len(self._etag_cache) > _ETAG_CACHE_MAX_ENTRIES:
+                self._etag_cache.popitem(last=False)
+
+    def _update_bucket(self, response) -> None:
+        # GitHub sends X-RateLimit-*, GitLab sends RateLimit-*
+        remaining = response.headers.get("X-RateLimit-Remaining", response.headers.get("RateLimit-Remaining"))
+        reset_at = response.headers.get("X-RateLimit-Reset", response.headers.get("RateLimit-Reset"))
+        if remaining is not None and reset_at is not None:
+            self.bucket.update(int(remaining), float(reset_at))
+
+    @staticmethod
+    def _is_rate_limited(response) -> bool:
+        if response.status_code == 429:
+            return True
+        return response.status_code == 403 and (
+            "Retry-After" in response.headers
+            or response.headers.get("X-RateLimit-Remaining", response.headers.get("RateLimit-Remaining")) == "0"
+        )
+
+
+def _retry_after_seconds(retry_after: Optional[str], default: float) -> float:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not retry_after:
+        return default
+    try:
+        seconds = float(retry_after)
+        return max(seconds, 0) if math.isfinite(seconds) else default
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+def _create_github_client(inputs: dict, pool_size: int) -> Github:
+    # PyGithub manages its own sessions, GithubRetry waits out primary and secondary rate limits from the headers
+    return Github(
+        inputs['github_api_key'],
+        per_page=100,
+        pool_size=pool_size,
+        retry=GithubRetry(total=_RATE_LIMIT_RETRIES),
+    )
+
+
+def _create_gitlab_client(inputs: dict, pool_size: int) -> Gitlab:
+    session = requests.Session()
+    adapter = _RateLimitedAdapter(
+        _TokenBucket(rate_per_second=10, capacity=pool_size),
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return Gitlab(
+        inputs.get('gitlab_url', 'https://gitlab.com'),
+        private_token=inputs['gitlab_api_key'],
+        session=session,
+        per_page=100,
+        retry_transient_errors=True,
+    )
+
+
+def _git(*args: str, cwd: Path = None) -> None:
+    subprocess.run(["git", *args], cwd=cwd, check=True)
+
+
+def _dir_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+class _RepoCache:
+    """On-disk cache of bare mirrors, evicted least recently used first once it grows past max_size_mb."""
+
+    def __init__(self, cache_dir: str, max_size_mb: int):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+
+    def _mirror_path(self, clone_url: str) -> Path:
+        digest = hashlib.sha1(clone_url.encode()).hexdigest()[:12]
+        return self.cache_dir / f"{Path(clone_url).stem}-{digest}.git"
+
+    def checkout(self, clone_url: str, repo_path: Path) -> None:
+        mirror = self._mirror_path(clone_url)
+        if mirror.is_dir():
+            _git("fetch", "--prune", "origin", cwd=mirror)
+        else:
+            try:
+                _git("clone", "--bare", clone_url, str(mirror))
+                _git("config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*", cwd=mirror)
+                # Working copies borrow objects from the mirror, so it must never prune them on its own
+                _git("config", "gc.auto", "0", cwd=mirror)
+            except Exception:
+                shutil.rmtree(mirror, ignore_errors=True)
+                raise
+        os.utime(mirror)  # Mark as recently used
+
+        _git("clone", "--shared", str(mirror), str(repo_path))
+        _git("remote", "set-url", "origin", clone_url, cwd=repo_path)
+
+    def evict(self) -> None:
+        mirrors = sorted(self.cache_dir.glob("*.git"), key=lambda mirror: mirror.stat().st_mtime)
+        sizes = {mirror: _dir_size(mirror) for mirror in mirrors}
+        total_size = sum(sizes.values())
+        for mirror in mirrors:
+            if total_size <= self.max_size:
+                break
+            logger.info(f"Evicting {mirror.name} from the repo cache")
+            shutil.rmtree(mirror, ignore_errors=True)
+            total_size -= sizes[mirror]
+
+
+def _rewrite_polyfill_url(match: re.Match):
+    path = match.group("path") or ""
+    for host_pattern, path_prefix, new_path_prefix in _POLYFILL_REWRITES:
+        if host_pattern.fullmatch(match.group("host")) and path.startswith(path_prefix):
+            scheme = "//" if match.group("scheme") == "//" else "https://"
+            return f"{scheme}cdnjs.cloudflare.com{new_path_prefix}{path[len(path_prefix):]}"
+    return None
+
+
+def _scan_polyfill(repo_path: Path):
+    """
+    Walks the checkout once and returns the deterministic rewrites as {path: (new_content, count)}
+    and the references without a known safe replacement as [(path, line, url)].
+    """
+    rewrites = {}
+    ambiguous = []
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [directory for directory in dirs if directory not in _POLYFILL_SKIP_DIRS]
+        for file_name in files:
+            file_path = Path(root) / file_name
+            if file_path.suffix.lower() not in _POLYFILL_SCAN_EXTENSIONS:
+                continue
+
+            content = file_path.read_text(encoding="utf-8", errors="surrogateescape")
+            if _POLYFILL_URL_PATTERN.search(content) is None:
+                continue
+
+            count = 0
+
+            def replace(match: re.Match) -> str:
+                nonlocal count
+                new_url = _rewrite_polyfill_url(match)
+                if new_url is None:
+                    line = content.count("\n", 0, match.start()) + 1
+                    ambiguous.append((file_path, line, match.group(0)))
+                    return match.group(0)
+                count += 1
+                return new_url
+
+            new_content = _POLYFILL_URL_PATTERN.sub(replace, content)
+            if count > 0:
+                rewrites[file_path] = (new_content, count)
+
+    return rewrites, ambiguous
+
+
+def _sparse_scan_polyfill(clone_url: str, triage_path: Path) -> bool:
+    # Only the web asset files of the default branch tip are downloaded
+    try:
+        _git("clone", "--depth", "1", "--filter=blob:none", "--no-checkout", clone_url, str(triage_path))
+        _git("sparse-checkout", "set", "--no-cone", *[f"*{ext}" for ext in _POLYFILL_SCAN_EXTENSIONS], cwd=triage_path)
+        _git("checkout", cwd=triage_path)
+        rewrites, ambiguous = _scan_polyfill(triage_path)
+        return len(rewrites) > 0 or len(ambiguous) > 0
+    finally:
+        shutil.rmtree(triage_path, ignore_errors=True)
+
+
+def _sarif_result_paths(result: dict, repo_path: Path) -> set:
+    paths = set()
+    for location in result.get("locations", []):
+        uri = location.get("physicalLocation", {}).get("artifactLocation", {}).get("uri")
+        if uri is not None:
+            paths.add((repo_path / unquote(urlparse(uri).path)).resolve())
+    return paths
+
+
+def _filter_sarif(sarif_values: dict, repo_path: Path, file_paths: Iterable) -> dict:
+    """Keeps the results of the SARIF log that are in one of file_paths."""
+    file_paths = {Path(file_path).resolve() for file_path in file_paths}
+    runs = [
+        dict(run, results=[
+            result for result in run.get("results", [])
+            if not file_paths.isdisjoint(_sarif_result_paths(result, repo_path))
+        ])
+        for run in sarif_values.get("runs", [])
+    ]
+    return dict(sarif_values, runs=runs)
+
+
+# Mirrors AutoFix.run of patchwork-cli 0.0.55 without its PR step, compare it again when patchwork is upgraded.
+# AutoFix can not be run with disable_pr instead, its CommitChanges still commits the fixes to a branch of its own.
+def _run_autofix(inputs: dict, tracer: Tracer, repo_name: str, file_paths: Optional[Iterable] = None) -> dict:
+    """
+    The steps of AutoFix up to ModifyCode, on the findings in file_paths when given. The PR step is left
+    to the caller, so a repo without changes never waits for a fix token.
+    """
+    autofix = AutoFix(inputs)
+    autofix_inputs = autofix.inputs
+    repo_path = Path(inputs.get('repo_path', os.getcwd()))
+    if file_paths is not None:
+        file_paths = set(file_paths)
+
+    def scan() -> dict:
+        outputs = tracer.run_step(ScanSemgrep, autofix_inputs, repo=repo_name)
+        # Every scan is filtered, the validation rounds must not pick up the files that were rewritten
+        if file_paths is not None and "sarif_values" in outputs:
+            outputs = dict(outputs, sarif_values=_filter_sarif(outputs["sarif_values"], repo_path, file_paths))
+        autofix_inputs.update(outputs)
+        outputs = tracer.run_step(ExtractCode, autofix_inputs, repo=repo_name)
+        autofix_inputs.update(outputs)
+        return outputs
+
+    outputs = scan()
+    for i in range(autofix.n):
+        autofix_inputs["prompt_values"] = outputs.get("files_to_patch", [])
+        outputs = tracer.run_step(LLM, autofix_inputs, repo=repo_name)
+        autofix_inputs.update(outputs)
+
+        for extracted_response in autofix_inputs["extracted_responses"]:
+            compatibility = Compatibility.from_str(extracted_response.get("compatibility", "UNKNOWN").strip())
+            if compatibility < autofix.compatibility_threshold:
+                extracted_response.pop("patch", None)
+
+        outputs = tracer.run_step(ModifyCode, autofix_inputs, repo=repo_name)
+        autofix_inputs.update(outputs)
+
+        if i == autofix.n - 1:
+            break
+
+        # validation
+        autofix_inputs.pop("sarif_file_path", None)
+        outputs = scan()
+        if autofix_inputs.get("prompt_value_file") is not None:
+            with open(autofix_inputs["prompt_value_file"], "r") as fp:
+                vulns = json.load(fp)
+            if len(vulns) < 1:
+                break
+
+    return autofix_inputs
+
+
+def _prepare_fix(inputs: dict, tracer: Tracer) -> dict:
+    """Fixes the files of the checkout, returns the inputs for the PR step."""
+    repo_path = Path(inputs.get('repo_path', os.getcwd()))
+    if not inputs.get('polyfill_fast_path', False):
+        return _run_autofix(inputs, tracer, repo_path.name)
+
+    with tracer.span("scan_polyfill", repo=repo_path.name):
+        rewrites, ambiguous = _scan_polyfill(repo_path)
+    if len(rewrites) < 1 and len(ambiguous) < 1:
+        logger.info("No polyfill references found")
+        return dict(inputs, modified_code_files=[])
+
+    modified_code_files = []
+    for file_path, (new_content, count) in rewrites.items():
+        file_path.write_text(new_content, encoding="utf-8", errors="surrogateescape")
+        modified_code_files.append(dict(
+            path=str(file_path),
+            commit_message=f"Replace {count} compromised polyfill CDN URL(s) with cdnjs",
+            patch_message="The URLs now point to the cdnjs mirror from Cloudflare with the same path.",
+        ))
+
+    pr_inputs = dict(inputs)
+    if len(ambiguous) > 0:
+        for file_path, line, url in ambiguous:
+            logger.info(f"No deterministic fix for {url} in {file_path}:{line}")
+        # The rewritten references are already gone, AutoFix only gets the files it has to look at
+        ambiguous_files = {file_path for file_path, _, _ in ambiguous}
+        logger.info(f"Falling back to AutoFix for {len(ambiguous_files)} files")
+        pr_inputs = _run_autofix(inputs, tracer, repo_path.name, ambiguous_files)
+        modified_code_files.extend(pr_inputs.get("modified_code_files", []))
+
+    pr_inputs["modified_code_files"] = modified_code_files
+    pr_inputs["pr_title"] = "PatchWork Fixpolyfill"
+    number = len({Path(modified_code_file["path"]).resolve() for modified_code_file in modified_code_files})
+    pr_inputs["pr_header"] = f"This pull request from patchwork replaces compromised polyfill CDN URLs in {number} files."
+    pr_inputs["branch_prefix"] = "fixpolyfill-"
+    return pr_inputs
+
+
+def _open_pr(pr_inputs: dict, tracer: Tracer) -> dict:
+    repo_path = Path(pr_inputs.get('repo_path', os.getcwd()))
+    outputs = tracer.run_step(PR, pr_inputs, repo=repo_path.name)
+    pr_inputs.update(outputs)
+    return pr_inputs
+
+
+def _fix_repo(inputs: dict, tracer: Tracer, acquire_fix_token: Optional[Callable[[], None]] = None) -> dict:
+    pr_inputs = _prepare_fix(inputs, tracer)
+    if len(pr_inputs.get("modified_code_files", [])) < 1:
+        return pr_inputs
+    if acquire_fix_token is not None:
+        # Only a fix that pushes a branch and opens a PR counts against the write rate limits
+        acquire_fix_token()
+    return _open_pr(pr_inputs, tracer)
+
+
+def _fix_repo_in_cwd(inputs: dict, repo_path: Path, tracer: Tracer, acquire_fix_token: Callable[[], None]) -> dict:
+    original_dir = os.getcwd()
+    try:
+        os.chdir(repo_path)
+        return _fix_repo(inputs, tracer, acquire_fix_token)
+    finally:
+        os.chdir(original_dir)  # Always return to the original directory
+
+
+def _run_worker(stage: str, inputs: dict, repo_path: Path, work_dir: Path, tracer: Tracer) -> dict:
+    # Keep the exchange files outside the clone so they never end up in the PR
+    inputs_file = work_dir / f"{repo_path.name}.{stage}.inputs.json"
+    outputs_file = work_dir / f"{repo_path.name}.{stage}.outputs.json"
+    spans_file = work_dir / f"{repo_path.name}.{stage}.spans.jsonl"
+    inputs = dict(inputs)
+    if tracer.enabled:
+        # The worker records its steps into its own file, merged back into this trace afterwards
+        inputs['trace_file'] = str(spans_file)
+        inputs['trace_format'] = "jsonl"
+    inputs_file.write_text(json.dumps(inputs, default=str))
+
+    subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), stage, str(inputs_file), str(outputs_file)],
+        cwd=repo_path,
+        check=True,
+    )
+    tracer.merge(spans_file)
+    return json.loads(outputs_file.read_text())
+
+
+def _fix_repo_in_subprocess(
+    inputs: dict, repo_path: Path, work_dir: Path, tracer: Tracer, acquire_fix_token: Callable[[], None]
+) -> dict:
+    # The fix token is taken in this process between the two stages, the workers do not share the bucket
+    pr_inputs = _run_worker("fix", inputs, repo_path, work_dir, tracer)
+    if len(pr_inputs.get("modified_code_files", [])) < 1:
+        return pr_inputs
+    acquire_fix_token()
+    return _run_worker("pr", pr_inputs, repo_path, work_dir, tracer)
+
+
+class _RepoStateStore:
+    """Default branch HEAD and outcome of the last run per repo, saved after every repo so runs can resume."""
+
+    def __init__(self, state_file: str):
+        self.state_file = Path(state_file).expanduser()
+        self._state = json.loads(self.state_file.read_text()) if self.state_file.is_file() else {}
+        self._lock = threading.Lock()
+
+    def is_unchanged(self, repo_key: str, head_sha: str) -> bool:
+        entry = self._state.get(repo_key)
+        return entry is not None and entry["sha"] == head_sha and entry["outcome"] == "success"
+
+    def record(self, repo_key: str, head_sha: str, pr_url: str, outcome: str) -> None:
+        with self._lock:
+            self._state[repo_key] = {
+                "sha": head_sha,
+                "outcome": outcome,
+                "pr_url": pr_url,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+            tmp_file.write_text(json.dumps(self._state, indent=2))
+            os.replace(tmp_file, self.state_file)
+
+
+def _get_repo_key(repo) -> str:
+    return repo.full_name if hasattr(repo, 'full_name') else repo.path_with_namespace
+
+
+def _get_triage_key(repo):
+    # GitLab blob search results only carry the project id
+    return repo.full_name if hasattr(repo, 'full_name') else repo.id
+
+
+def _get_head_sha(repo) -> str:
+    if hasattr(repo, 'get_branch'):
+        return repo.get_branch(repo.default_branch).commit.sha
+    # GitLab list results are partial objects, the branches manager lives on the full project
+    project = repo.manager.gitlab.projects.get(repo.id, lazy=True)
+    return project.branches.get(repo.default_branch).commit['id']
+
+
+def _is_fork(repo) -> bool:
+    if hasattr(repo, 'fork'):
+        return repo.fork
+    return 'forked_from_project' in repo.attributes
+
+
+def _get_last_pushed_at(repo):
+    return repo.pushed_at if hasattr(repo, 'pushed_at') else repo.last_activity_at
+
+
+def _get_languages(repo) -> set:
+    if hasattr(repo, 'language'):
+        return {repo.language.lower()} if repo.language else set()
+    # GitLab does not return languages in project listings
+    project = repo.manager.gitlab.projects.get(repo.id, lazy=True)
+    return {language.lower() for language in project.languages()}
+
+
+def _to_utc(value) -> datetime:
+    if not isinstance(value, datetime):
+        # GitLab timestamps end in Z, which fromisoformat only accepts from Python 3.11
+        value = datetime.fromisoformat(re.sub(r"[Zz]$", "+00:00", str(value)))
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def _bounded_map(fn: Callable, items: Iterable, max_workers: int) -> list:
+    # Like executor.map, but items are pulled lazily so work starts while the repos are still being listed
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_workers * 2:
+                results.append(pending.popleft().result())
+        results.extend(future.result() for future in pending)
+    return results
+
 
 class Fixpolyfill(Step):
     def __init__(self, inputs: dict):
-        final_inputs = yaml.safe_load(_DEFAULT_INPUT_FILE.read_text())
-                    
-        if final_inputs is None:
-            final_inputs = {}
-        final_inputs.update(inputs)
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
             
         if "prompt_template_file" not in final_inputs.keys():
             final_inputs["prompt_template_file"] = _DEFAULT_PROMPT_JSON
+        # AutoFix fills the prompt with the code contexts found by ExtractCode
+        load_prompts(
+            final_inputs["prompt_template_file"],
+            {final_inputs.get("prompt_id", "fixprompt"): {"uri", "startLine", "endLine", "affectedCode", "messageText"}}
+        )
         
         self.inputs = final_inputs
 
+        self.repo_cache = None
+        if 'repo_cache_dir' in final_inputs:
+            self.repo_cache = _RepoCache(
+                final_inputs['repo_cache_dir'],
+                int(final_inputs.get('repo_cache_max_size_mb', _DEFAULT_REPO_CACHE_MAX_SIZE_MB))
+            )
+
+        self.repo_state = None
+        if 'repo_state_file' in final_inputs:
+            self.repo_state = _RepoStateStore(final_inputs['repo_state_file'])
+
+        self.pre_clone_triage = bool(final_inputs.get('pre_clone_triage', False))
+        self.triage_candidates = None
+
+        self.api_pool_size = int(final_inputs.get(
+            'api_pool_size',
+            max(_DEFAULT_API_POOL_SIZE, int(final_inputs.get('max_parallel_repos', 1)))
+        ))
+        # Every repo with changes pushes a branch and opens a PR, which count against the write rate limits
+        max_fixes_per_minute = float(final_inputs.get('api_max_fixes_per_minute', _DEFAULT_API_MAX_FIXES_PER_MINUTE))
+        if max_fixes_per_minute <= 0:
+            raise ValueError(f"api_max_fixes_per_minute must be greater than 0, got {max_fixes_per_minute:g}")
+        self.fix_bucket = _TokenBucket(rate_per_second=max_fixes_per_minute / 60, capacity=1)
+        self.github_client = None
+
+        self.tracer = Tracer.from_inputs(final_inputs)
+
     def run(self) -> dict:
         if 'github_org_name' in self.inputs:
             return self.run_github_org()
@@ -37,19 +644,27 @@ class Fixpolyfill(Step):
             return self.run_single()
 
     def run_single(self) -> dict:
-        outputs = AutoFix(self.inputs).run()
+        try:
+            outputs = _fix_repo(self.inputs, self.tracer)
+        finally:
+            self.tracer.save()
+            self.tracer.print_summary()
         return outputs
 
     def run_github_org(self) -> dict:
         if 'github_api_key' not in self.inputs:
             raise ValueError("github_api_key is not provided in the inputs")
         
-        g = Github(self.inputs['github_api_key'])
+        g = _create_github_client(self.inputs, self.api_pool_size)
+        self.github_client = g
         
         try:
             # First, try to get the organization
             org = g.get_organization(self.inputs['github_org_name'])
-            repos = org.get_repos()
+            # "sources" lets the API drop forks before they are paginated
+            repos = org.get_repos(type='sources' if self._exclude_forks else 'all')
+            if self.pre_clone_triage:
+                self.triage_candidates = self._github_triage_candidates(g, f"org:{org.login}")
         except GithubException as e:
             if e.status == 404:
                 # If organization is not found, try to get it as a user
@@ -57,6 +672,8 @@ class Fixpolyfill(Step):
                     user = g.get_user(self.inputs['github_org_name'])
                     logger.warning(f"'{self.inputs['github_org_name']}' is a user account, not an organization. Processing user's repositories.")
                     repos = user.get_repos()
+                    if self.pre_clone_triage:
+                        self.triage_candidates = self._github_triage_candidates(g, f"user:{user.login}")
                 except GithubException:
                     logger.error(f"Could not find organization or user '{self.inputs['github_org_name']}'. Please check the name and your access rights.")
                     raise ValueError(f"Invalid GitHub organization or user name: {self.inputs['github_org_name']}")
@@ -73,12 +690,14 @@ class Fixpolyfill(Step):
         if 'gitlab_api_key' not in self.inputs:
             raise ValueError("gitlab_api_key is not provided in the inputs")
         
-        gl = Gitlab(self.inputs.get('gitlab_url', 'https://gitlab.com'), private_token=self.inputs['gitlab_api_key'])
+        gl = _create_gitlab_client(self.inputs, self.api_pool_size)
         
         try:
             gl.auth()
             group = gl.groups.get(self.inputs['gitlab_org_name'])
-            repos = group.projects.list(all=True)
+            repos = group.projects.list(iterator=True, **self._gitlab_list_filters())
+            if self.pre_clone_triage:
+                self.triage_candidates = self._gitlab_triage_candidates(group)
         except GitlabAuthenticationError:
             logger.error("Authentication failed. Please check your GitLab API key.")
             raise ValueError("Invalid GitLab API key")
@@ -88,7 +707,7 @@ class Fixpolyfill(Step):
                 try:
                     user = gl.users.list(username=self.inputs['gitlab_org_name'])[0]
                     logger.warning(f"'{self.inputs['gitlab_org_name']}' is a user account, not a group. Processing user's projects.")
-                    repos = user.projects.list(all=True)
+                    repos = user.projects.list(iterator=True, **self._gitlab_list_filters())
                 except IndexError:
                     logger.error(f"Could not find group or user '{self.inputs['gitlab_org_name']}'. Please check the name and your access rights.")
                     raise ValueError(f"Invalid GitLab group or user name: {self.inputs['gitlab_org_name']}")
@@ -98,41 +717,210 @@ class Fixpolyfill(Step):
         
         return self._process_repos(repos)
 
-    def _process_repos(self, repos) -> dict:
-        results = []
-        original_dir = os.getcwd()
-        
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            for repo in repos:
-                print(f"Processing {repo.name}...")
-                repo_path = Path(tmp_dir) / repo.name
+    def _github_triage_candidates(self, g: Github, qualifier: str) -> Optional[set]:
+        candidates = set()
+        try:
+            for host in _POLYFILL_HOSTS:
+                results = g.search_code(f'"{host}" {qualifier}')
+                if results.totalCount >= _GITHUB_CODE_SEARCH_LIMIT:
+                    logger.warning(f"Too many code search results for {host}, triaging with sparse checkouts instead")
+                    return None
+                candidates.update(result.repository.full_name for result in results)
+        except GithubException as e:
+            logger.warning(f"GitHub code search failed, triaging with sparse checkouts instead: {str(e)}")
+            return None
+        return candidates
+
+    def _gitlab_triage_candidates(self, group) -> Optional[set]:
+        candidates = set()
+        try:
+            for host in _POLYFILL_HOSTS:
+                results = group.search('blobs', host, iterator=True)
+                candidates.update(result['project_id'] for result in results)
+        except Exception as e:
+            # Group wide blob search needs advanced search on the GitLab instance
+            logger.warning(f"GitLab blob search failed, triaging with sparse checkouts instead: {str(e)}")
+            return None
+        return candidates
+
+    def _is_triage_candidate(self, repo, clone_url: str, tmp_dir: Path) -> bool:
+        # GitHub does not index most forks for code search
+        if self.triage_candidates is not None and not getattr(repo, 'fork', False):
+            return _get_triage_key(repo) in self.triage_candidates
+
+        try:
+            return _sparse_scan_polyfill(clone_url, tmp_dir / f"{repo.name}.triage")
+        except Exception as e:
+            logger.warning(f"Could not triage {repo.name}, processing it fully: {str(e)}")
+            return True
+
+    @property
+    def _exclude_forks(self) -> bool:
+        return bool(self.inputs.get('exclude_forked_repos', False))
+
+    def _gitlab_list_filters(self) -> dict:
+        # _filter_repos checks these again, the API only saves listing the projects that would be dropped
+        filters = {}
+        if self.inputs.get('exclude_archived_repos', False):
+            filters['archived'] = False
+        if self.inputs.get('repo_pushed_after') is not None:
+            filters['last_activity_after'] = _to_utc(self.inputs['repo_pushed_after']).isoformat()
+        return filters
+
+    def _filter_repos(self, repos: Iterable) -> Iterator:
+        exclude_archived = bool(self.inputs.get('exclude_archived_repos', False))
+        languages = {
+            language.strip().lower()
+            for language in str(self.inputs.get('repo_languages', '')).split(',')
+            if language.strip()
+        }
+        pushed_after = self.inputs.get('repo_pushed_after')
+        if pushed_after is not None:
+            pushed_after = _to_utc(pushed_after)
+
+        for repo in repos:
+            if exclude_archived and repo.archived:
+                continue
+            if self._exclude_forks and _is_fork(repo):
+                continue
+            if pushed_after is not None:
+                # Empty GitHub repos have never been pushed to and have no pushed_at
+                last_pushed_at = _get_last_pushed_at(repo)
+                if last_pushed_at is None or _to_utc(last_pushed_at) < pushed_after:
+                    continue
+            if languages:
                 try:
-                    os.chdir(tmp_dir)  # Change to temp directory before cloning
-                    clone_url = repo.clone_url if hasattr(repo, 'clone_url') else repo.http_url_to_repo
-                    os.system(f"git clone {clone_url} {repo.name}")
-                    os.chdir(repo_path)
-                    
-                    inputs_copy = self.inputs.copy()
-                    inputs_copy['repo_path'] = str(repo_path)
-                    outputs = AutoFix(inputs_copy).run()
-                    
-                    results.append({
-                        'repo': repo.name,
-                        'pr_url': outputs.get("pr_url", "")
-                    })
+                    repo_languages = _get_languages(repo)
                 except Exception as e:
-                    logger.error(f"Error processing repository {repo.name}: {str(e)}")
-                    results.append({
-                        'repo': repo.name,
-                        'pr_url': f"Error: {str(e)}"
-                    })
-                finally:
-                    os.chdir(original_dir)  # Always return to the original directory
-        
+                    # One project whose languages can not be read must not end the org run, it is fixed anyway
+                    logger.warning(f"Could not get the languages of {repo.name}, processing it anyway: {str(e)}")
+                    repo_languages = languages
+                if not languages.intersection(repo_languages):
+                    continue
+            yield repo
+
+    def _process_repos(self, repos) -> dict:
+        max_parallel_repos = int(self.inputs.get('max_parallel_repos', 1))
+        repos = self._filter_repos(repos)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, self.tracer.span("process_repos"):
+            if max_parallel_repos > 1:
+                # AutoFix and PR rely on the process-global cwd, so every worker runs them in its own process
+                results = _bounded_map(
+                    lambda repo: self._process_repo(repo, Path(tmp_dir), isolated=True),
+                    repos,
+                    max_parallel_repos
+                )
+            else:
+                results = [self._process_repo(repo, Path(tmp_dir)) for repo in repos]
+
+        if self.repo_cache is not None:
+            self.repo_cache.evict()
+
+        self.tracer.save()
         self.print_summary(results)
         return self.inputs
 
+    def _process_repo(self, repo, tmp_dir: Path, isolated: bool = False) -> dict:
+        with self.tracer.span("repo", repo=repo.name):
+            print(f"Processing {repo.name}...")
+            repo_key = _get_repo_key(repo)
+            head_sha = None
+            if self.repo_state is not None:
+                try:
+                    head_sha = _get_head_sha(repo)
+                except Exception as e:
+                    logger.warning(f"Could not get the default branch HEAD of {repo.name}: {str(e)}")
+
+                if head_sha is not None and self.repo_state.is_unchanged(repo_key, head_sha):
+                    print(f"Skipping {repo.name}, unchanged since the last run")
+                    return {
+                        'repo': repo.name,
+                        'pr_url': "Skipped: unchanged since the last run"
+                    }
+
+            repo_path = tmp_dir / repo.name
+            try:
+                clone_url = repo.clone_url if hasattr(repo, 'clone_url') else repo.http_url_to_repo
+                with self.tracer.span("triage", repo=repo.name):
+                    is_candidate = not self.pre_clone_triage or self._is_triage_candidate(repo, clone_url, tmp_dir)
+                if not is_candidate:
+                    print(f"Skipping {repo.name}, no polyfill references found")
+                    pr_url = _TRIAGED_OUT
+                else:
+                    with self.tracer.span("git clone", repo=repo.name):
+                        self._clone_repo(clone_url, repo_path)
+
+                    inputs_copy = self.inputs.copy()
+                    inputs_copy['repo_path'] = str(repo_path)
+                    acquire_fix_token = partial(self._wait_for_api_capacity, repo.name)
+                    if isolated:
+                        with self.tracer.span("fix_repo_subprocess", repo=repo.name):
+                            outputs = _fix_repo_in_subprocess(
+                                inputs_copy, repo_path, tmp_dir, self.tracer, acquire_fix_token
+                            )
+                    else:
+                        outputs = _fix_repo_in_cwd(inputs_copy, repo_path, self.tracer, acquire_fix_token)
+
+                    pr_url = outputs.get("pr_url", "")
+                outcome = "success"
+            except Exception as e:
+                logger.error(f"Error processing repository {repo.name}: {str(e)}")
+                pr_url = f"Error: {str(e)}"
+                outcome = "error"
+
+            if self.repo_state is not None and head_sha is not None:
+                self.repo_state.record(repo_key, head_sha, pr_url, outcome)
+
+            return {
+                'repo': repo.name,
+                'pr_url': pr_url
+            }
+
+    def _wait_for_api_capacity(self, repo_name: str) -> None:
+        # Called right before the PR step of a repo that has changes
+        with self.tracer.span("wait_for_api_capacity", repo=repo_name):
+            if self.github_client is not None:
+                # The fixes use the same token, so hold them back when the shared quota is nearly spent
+                remaining, _ = self.github_client.rate_limiting
+                reserve = int(self.inputs.get('api_rate_limit_reserve', _DEFAULT_API_RATE_LIMIT_RESERVE))
+                if remaining < reserve:
+                    logger.warning("GitHub API rate limit is nearly used up, waiting for it to reset")
+                    self.fix_bucket.pause_until(self.github_client.rate_limiting_resettime)
+            self.fix_bucket.acquire()
+
+    def _clone_repo(self, clone_url: str, repo_path: Path) -> None:
+        if self.repo_cache is not None:
+            self.repo_cache.checkout(clone_url, repo_path)
+            return
+
+        clone_args = []
+        if 'clone_depth' in self.inputs:
+            clone_args.extend(["--depth", str(self.inputs['clone_depth'])])
+        if 'clone_filter' in self.inputs:
+            clone_args.append(f"--filter={self.inputs['clone_filter']}")
+        _git("clone", *clone_args, clone_url, str(repo_path))
+
     def print_summary(self, results):
         table = tabulate(results, headers="keys", tablefmt="grid")
         print("\nSummary of processed repositories:")
-        print(table)
\ No newline at end of file
+        print(table)
+        if self.pre_clone_triage:
+            triaged_out = sum(1 for result in results if result['pr_url'] == _TRIAGED_OUT)
+            print(f"{triaged_out} of {len(results)} repositories were triaged out before cloning")
+        self.tracer.print_summary()
+
+
+if __name__ == "__main__":
+    # Worker entrypoint used by _fix_repo_in_subprocess, fixes the repo in the cwd or opens its PR
+    worker_stage = sys.argv[1]
+    worker_inputs = json.loads(Path(sys.argv[2]).read_text())
+    worker_tracer = Tracer.from_inputs(worker_inputs)
+    try:
+        if worker_stage == "fix":
+            worker_outputs = _prepare_fix(worker_inputs, worker_tracer)
+        else:
+            worker_outputs = _open_pr(worker_inputs, worker_tracer)
+    finally:
+        worker_tracer.save()
+    Path(sys.argv[3]).write_text(json.dumps(worker_outputs, default=str))
@@ -0,0 +1,275 @@
+import ast
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from patchwork import patchflows
+from patchwork.logger import logger
+from patchwork.step import Step
+from patchwork.steps import (
+    PR,
+    SimplifiedLLMOnce,
+)
+
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config, load_prompts  # noqa: E402
+from patchflow_tracing import Tracer  # noqa: E402
+from llm_cache import LLMCache  # noqa: E402
+
+_DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
+_DEFAULT_PROMPT_JSON = Path(__file__).parent / "prompt.json"
+
+_DEFAULT_BATCH_SIZE = 10
+_DEFAULT_MAX_CONCURRENT_BATCHES = 4
+_SKIP_DIRS = {".git", ".hg", ".svn", ".patchwork", ".venv", "venv", "node_modules", "__pycache__", ".tox", ".nox"}
+_SYMBOL_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def _symbol_source(lines: list, node) -> str:
+    """The source of a symbol, with the bodies of its methods collapsed so a class does not repeat them."""
+    start = (node.decorator_list[0].lineno if node.decorator_list else node.lineno) - 1
+    collapsed = {}
+    if isinstance(node, ast.ClassDef):
+        for child in node.body:
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and child.body[0].lineno > child.lineno:
+                collapsed[child.body[0].lineno - 1] = child.end_lineno
+    source = []
+    index = start
+    while index < node.end_lineno:
+        if index in collapsed:
+            indent = lines[index][:len(lines[index]) - len(lines[index].lstrip())]
+            source.append(f"{indent}...\n")
+            index = collapsed[index]
+            continue
+        source.append(lines[index])
+        index += 1
+    return "".join(source)
+
+
+def _index_symbols(file_path: Path, rewrite_existing: bool) -> list:
+    """Functions, methods and classes of a Python file that need a docstring, found with its syntax tree."""
+    try:
+        text = file_path.read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError) as e:
+        logger.warning(f"Skipping {file_path}, it can not be read as UTF-8: {e}")
+        return []
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError) as e:
+        # ValueError for source with null bytes
+        logger.warning(f"Skipping {file_path}, it does not parse: {e}")
+        return []
+    lines = text.splitlines(keepends=True)
+
+    symbols = []
+
+    def visit(node, prefix: str):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, _SYMBOL_NODES):
+                visit(child, prefix)
+                continue
+            qualname = f"{prefix}{child.name}"
+            first = child.body[0]
+            has_docstring = ast.get_docstring(child, clean=False) is not None
+            # A body on the line of the def has no line a docstring can be put on
+            if first.lineno > child.lineno and (rewrite_existing or not has_docstring):
+                symbols.append(dict(
+                    id=f"{qualname}:{child.lineno}",
+                    qualname=qualname,
+                    kind="class" if isinstance(child, ast.ClassDef) else "function",
+                    line=child.lineno,
+                    # 0-based lines the docstring replaces, an empty range when it is inserted
+                    start_line=first.lineno - 1,
+                    end_line=first.end_lineno if has_docstring else first.lineno - 1,
+                    indent=lines[first.lineno - 1][:first.col_offset],
+                    source=_symbol_source(lines, child),
+                ))
+            visit(child, f"{qualname}.")
+
+    visit(tree, "")
+    return symbols
+
+
+def _is_valid_docstrings(response) -> bool:
+    items = response.get("docstrings") if isinstance(response, dict) else None
+    return isinstance(items, list) and len(items) > 0 and all(
+        isinstance(item, dict) and isinstance(item.get("id"), str) and isinstance(item.get("docstring"), str)
+        for item in items
+    )
+
+
+def _format_docstring(docstring: str, indent: str) -> str:
+    docstring = docstring.strip()
+    # Only quotes wrapping the whole answer are the model's, quotes inside the text are escaped below
+    for quotes in ('"""', "'''"):
+        if len(docstring) >= 6 and docstring.startswith(quotes) and docstring.endswith(quotes):
+            docstring = docstring[3:-3].strip()
+            break
+    docstring = docstring.replace("\\", "\\\\").replace('"""', '\\"\\"\\"')
+    lines = docstring.splitlines()
+    # A quote right before the closing quotes would end the string early
+    if len(lines) == 1 and not lines[0].endswith('"'):
+        return f'{indent}"""{lines[0]}"""\n'
+    body = "".join(f"{indent}{line}\n" if line.strip() else "\n" for line in lines)
+    return f'{indent}"""\n{body}{indent}"""\n'
+
+
+class GenerateDocstring(Step):
+    def __init__(self, inputs: dict):
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
+
+        if "prompt_template_file" not in final_inputs.keys():
+            final_inputs["prompt_template_file"] = _DEFAULT_PROMPT_JSON
+        self.batched = bool(final_inputs.get("batched", False))
+        if self.batched:
+            self.prompts = load_prompts(
+                final_inputs["prompt_template_file"], {"generate_docstring_batch": {"path", "count", "symbols"}}
+            )
+
+        self.inputs = final_inputs
+
+        self.base_path = Path(final_inputs.get("base_path", os.getcwd()))
+        self.rewrite_existing = bool(final_inputs.get("rewrite_existing", False))
+        self.batch_size = max(1, int(final_inputs.get("docstring_batch_size", _DEFAULT_BATCH_SIZE)))
+        self.max_concurrent_batches = int(
+            final_inputs.get("max_concurrent_batches", _DEFAULT_MAX_CONCURRENT_BATCHES)
+        )
+
+        self.llm_step = SimplifiedLLMOnce
+        self.llm_cache = LLMCache.from_inputs(final_inputs)
+        if self.llm_cache is not None:
+            # Malformed answers are not cached, so a rerun asks the model again instead of replaying them
+            self.llm_step = self.llm_cache.wrap(SimplifiedLLMOnce, is_valid=_is_valid_docstrings)
+        self.tracer = Tracer.from_inputs(final_inputs)
+
+    def run(self) -> dict:
+        if not self.batched:
+            # One generate_docstring call per function, as the GenerateDocstring that ships with patchwork does
+            return patchflows.GenerateDocstring(self.inputs).run()
+
+        with self.tracer.span("index_symbols"):
+            symbols_by_file = {}
+            indexed = 0
+            for dirpath, dirnames, filenames in os.walk(self.base_path):
+                dirnames[:] = sorted(name for name in dirnames if name not in _SKIP_DIRS and not name.startswith("."))
+                for filename in sorted(filenames):
+                    if not filename.endswith(".py"):
+                        continue
+                    file_path = Path(dirpath) / filename
+                    symbols = _index_symbols(file_path, self.rewrite_existing)
+                    indexed += 1
+                    if symbols:
+                        symbols_by_file[file_path] = symbols
+
+        # Symbols of one file share a request, so the model sees them together and the file is read once
+        batches = [
+            (file_path, symbols[i:i + self.batch_size])
+            for file_path, symbols in symbols_by_file.items()
+            for i in range(0, len(symbols), self.batch_size)
+        ]
+        number = sum(len(symbols) for symbols in symbols_by_file.values())
+        logger.info(f"Documenting {number} symbols of {len(symbols_by_file)} of {indexed} files in {len(batches)} requests")
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_batches) as executor:
+            results = list(executor.map(lambda batch: self._document_batch(*batch), batches))
+
+        docstrings_by_file = defaultdict(dict)
+        for (file_path, _), docstrings in zip(batches, results):
+            docstrings_by_file[file_path].update(docstrings)
+
+        modified_code_files = []
+        for file_path, symbols in symbols_by_file.items():
+            modified_code_files.extend(self._apply_docstrings(file_path, symbols, docstrings_by_file[file_path]))
+
+        if self.llm_cache is not None:
+            self.llm_cache.evict()
+            self.llm_cache.print_stats()
+
+        # All files go into one commit and one PR
+        self.inputs["modified_code_files"] = modified_code_files
+        self.inputs["pr_title"] = f"PatchWork {self.__class__.__name__}"
+        self.inputs["branch_prefix"] = f"{self.__class__.__name__.lower()}-"
+        self.inputs["pr_header"] = f"This pull request from patchwork fixes {len(modified_code_files)} docstrings."
+        outputs = self.tracer.run_step(PR, self.inputs)
+        self.inputs.update(outputs)
+
+        self.tracer.save()
+        self.tracer.print_summary()
+        return self.inputs
+
+    def _request(self, file_path: Path, symbols: list) -> dict:
+        template = self.prompts["generate_docstring_batch"]["prompts"]
+        inputs = dict(self.inputs)
+        inputs["prompt_system"] = next((message["content"] for message in template if message["role"] == "system"), None)
+        inputs["prompt_user"] = next(message["content"] for message in template if message["role"] == "user")
+        inputs["prompt_value"] = {
+            "path": file_path.relative_to(self.base_path).as_posix(),
+            "count": len(symbols),
+            "symbols": "\n".join(
+                f"### {symbol['id']} ({symbol['kind']})\n\n{symbol['source']}" for symbol in symbols
+            ),
+        }
+        inputs["json"] = True
+        try:
+            response = self.tracer.run_step(
+                self.llm_step, inputs, name="SimplifiedLLMOnce docstrings", path=inputs["prompt_value"]["path"]
+            )["extracted_response"]
+        except Exception as e:
+            logger.warning(f"Docstring request for {file_path} failed: {e}")
+            return {}
+
+        docstrings = {}
+        items = response.get("docstrings") if isinstance(response, dict) else None
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and isinstance(item.get("id"), str) and isinstance(item.get("docstring"), str):
+                if item["docstring"].strip():
+                    docstrings.setdefault(item["id"], item["docstring"])
+        return docstrings
+
+    def _document_batch(self, file_path: Path, symbols: list) -> dict:
+        docstrings = self._request(file_path, symbols)
+        if len(symbols) > 1:
+            # Symbols the batched answer missed are asked for on their own instead of failing the batch
+            for symbol in symbols:
+                if symbol["id"] not in docstrings:
+                    logger.info(f"Retrying the docstring of {symbol['qualname']} in {file_path} individually")
+                    docstrings.update(self._request(file_path, [symbol]))
+        return docstrings
+
+    def _apply_docstrings(self, file_path: Path, symbols: list, docstrings: dict) -> list:
+        try:
+            lines = file_path.read_text(encoding="utf-8").splitlines(keepends=True)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Docstrings for {file_path} were not applied, it can not be read: {e}")
+            return []
+        applied = []
+        # From the bottom up, so the lines of the symbols above are not moved
+        for symbol in sorted(symbols, key=lambda symbol: symbol["start_line"], reverse=True):
+            docstring = docstrings.get(symbol["id"])
+            if docstring is None:
+                continue
+            lines[symbol["start_line"]:symbol["end_line"]] = [_format_docstring(docstring, symbol["indent"])]
+            applied.append(symbol)
+        if not applied:
+            return []
+
+        new_text = "".join(lines)
+        try:
+            ast.parse(new_text)
+        except SyntaxError as e:
+            logger.warning(f"Docstrings for {file_path} were not applied, the file would not parse: {e}")
+            return []
+        file_path.write_text(new_text, encoding="utf-8")
+        return [
+            dict(
+                path=str(file_path),
+                start_line=symbol["start_line"],
+                end_line=symbol["end_line"],
+                commit_message=f"Docstring for {symbol['qualname']}",
+            )
+            for symbol in reversed(applied)
+        ]
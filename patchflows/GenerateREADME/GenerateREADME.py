@@ -0,0 +1,275 @@
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from patchwork import patchflows
+from patchwork.logger import logger
+from patchwork.step import Step
+from patchwork.steps import (
+    LLM,
+    PR,
+    ModifyCode,
+)
+
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config, load_prompts  # noqa: E402
+from patchflow_tracing import Tracer  # noqa: E402
+
+_DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
+_DEFAULT_PROMPT_JSON = Path(__file__).parent / "prompt.json"
+_DEFAULT_CACHE_FILE = ".patchwork/generate_readme_cache.json"
+
+# Bump whenever the summary prompts change, so cached summaries are regenerated
+_PROMPT_VERSION = "1"
+
+_DEFAULT_MAX_CONCURRENT_SUMMARIES = 8
+# Files above this estimate are cut before they are summarized, so one file can not overflow the context
+_DEFAULT_FILE_MAX_TOKENS = 6000
+_SKIP_DIRS = {".git", ".hg", ".svn", ".patchwork", ".venv", "venv", "node_modules", "__pycache__", ".tox", ".nox"}
+
+
+def _sha256(value) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def _matching_files(folder_path: Path, patterns: list, markdown_file_name: str) -> list:
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder_path):
+        dirnames[:] = sorted(name for name in dirnames if name not in _SKIP_DIRS and not name.startswith("."))
+        for filename in sorted(filenames):
+            relative_path = (Path(dirpath) / filename).relative_to(folder_path).as_posix()
+            if relative_path == markdown_file_name:
+                continue
+            if any(fnmatch.fnmatch(filename, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in patterns):
+                files.append(relative_path)
+    return files
+
+
+class _SummaryCache:
+    """
+    Summaries by the hash of what they were generated from, a file's content or the summaries below a directory.
+
+    Keyed by content and not by path, so a renamed file or moved folder keeps its summary.
+    """
+
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self._entries = json.loads(cache_file.read_text()) if cache_file.is_file() else {}
+        self._used = {}
+        self._lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def lookup(self, kind: str, key: Optional[str]) -> Optional[str]:
+        # No key when something below failed to summarize, that counts as a miss
+        summary = self._entries.get(key) if key is not None else None
+        with self._lock:
+            if summary is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            self._used[key] = summary
+        return summary
+
+    def store(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._used[key] = summary
+
+    def save(self) -> bool:
+        """Writes the cache file, returns whether its content changed."""
+        # Only what this run used is kept, summaries of deleted and changed files drop out
+        content = json.dumps(self._used, indent=2, sort_keys=True)
+        if self.cache_file.is_file() and self.cache_file.read_text() == content:
+            return False
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        tmp_file.write_text(content)
+        os.replace(tmp_file, self.cache_file)
+        return True
+
+    def print_report(self, request_tokens: int, response_tokens: int) -> None:
+        print()
+        for kind, label in (("file", "File summaries"), ("directory", "Folder summaries"), ("readme", "README")):
+            print(f"{label}: {self.hits[kind]} unchanged, {self.misses[kind]} regenerated")
+        print(f"Tokens used: {request_tokens} prompt, {response_tokens} completion")
+
+
+class GenerateREADME(Step):
+    def __init__(self, inputs: dict):
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
+
+        if "prompt_template_file" not in final_inputs.keys():
+            final_inputs["prompt_template_file"] = _DEFAULT_PROMPT_JSON
+        self.hierarchical = bool(final_inputs.get("hierarchical", False))
+        if self.hierarchical:
+            load_prompts(
+                final_inputs["prompt_template_file"],
+                {
+                    "generateREADME": {"fullContent"},
+                    "generateREADME_file": {"path", "fullContent"},
+                    "generateREADME_directory": {"path", "summaries"},
+                }
+            )
+
+        self.inputs = final_inputs
+
+        self.folder_path = Path(final_inputs.get("folder_path", Path.cwd()))
+        self.markdown_file_name = final_inputs.get("markdown_file_name", "README.md")
+        self.max_concurrent_summaries = int(
+            final_inputs.get("max_concurrent_summaries", _DEFAULT_MAX_CONCURRENT_SUMMARIES)
+        )
+        self.file_max_tokens = int(final_inputs.get("summary_file_max_tokens", _DEFAULT_FILE_MAX_TOKENS))
+        self.summary_cache = _SummaryCache(
+            self.folder_path / final_inputs.get("summary_cache_file", _DEFAULT_CACHE_FILE)
+        )
+
+        self.tokens_lock = threading.Lock()
+        self.request_tokens = 0
+        self.response_tokens = 0
+        self.tracer = Tracer.from_inputs(final_inputs)
+
+    def run(self) -> dict:
+        if not self.hierarchical:
+            # The whole filtered folder in one prompt, as the GenerateREADME that ships with patchwork does
+            return patchflows.GenerateREADME(self.inputs).run()
+
+        patterns = [pattern.strip() for pattern in self.inputs.get("filter", "*").split(",") if pattern.strip()]
+        with self.tracer.span("index_files"):
+            files = _matching_files(self.folder_path, patterns, self.markdown_file_name)
+        if not files:
+            logger.warning(f"No files in {self.folder_path} match {patterns}")
+            return self.inputs
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_summaries) as executor:
+            # Every file is summarized on its own, unchanged files come from the cache
+            file_summaries = dict(zip(files, executor.map(self._summarize_file, files)))
+
+            # Directories are rolled up from the deepest level to the root, each level concurrently
+            # A dict per folder keeps its entries in file order without duplicates
+            children = defaultdict(dict)
+            for path in files:
+                parts = path.split("/")
+                for depth in range(len(parts)):
+                    parent = "/".join(parts[:depth]) or "."
+                    child = "/".join(parts[:depth + 1])
+                    children[parent][child] = None
+            rollups = dict(file_summaries)
+            levels = defaultdict(list)
+            for path in children:
+                levels[0 if path == "." else path.count("/") + 1].append(path)
+            for depth in sorted(levels, reverse=True):
+                level = levels[depth]
+                for path, rollup in zip(level, executor.map(
+                        lambda path: self._roll_up(path, [(child, rollups[child]) for child in children[path]]),
+                        level)):
+                    rollups[path] = rollup
+
+        outputs = self._write_readme(rollups["."][0], children, rollups)
+
+        # Already saved before the PR step when a README was written
+        self.summary_cache.save()
+        self.summary_cache.print_report(self.request_tokens, self.response_tokens)
+        self.tracer.save()
+        self.tracer.print_summary()
+        return outputs
+
+    def _call_llm(self, prompt_id: str, prompt_values: dict, **extra_inputs) -> dict:
+        outputs = self.tracer.run_step(
+            LLM, dict(self.inputs, prompt_id=prompt_id, prompt_values=[prompt_values], **extra_inputs),
+            name=f"LLM {prompt_id}", path=prompt_values.get("path", ".")
+        )
+        with self.tokens_lock:
+            self.request_tokens += sum(outputs.get("request_tokens") or [])
+            self.response_tokens += sum(outputs.get("response_tokens") or [])
+        return outputs
+
+    def _summarize_file(self, path: str) -> tuple:
+        content = (self.folder_path / path).read_text(errors="replace")
+        key = _sha256(["file", _PROMPT_VERSION, self.inputs.get("model"), content])
+        summary = self.summary_cache.lookup("file", key)
+        if summary is None:
+            max_chars = self.file_max_tokens * 4
+            if len(content) > max_chars:
+                content = content[:max_chars] + f"\n... ({len(content) - max_chars} more characters not shown)"
+            outputs = self._call_llm("generateREADME_file", {"path": path, "fullContent": content})
+            summary = ((outputs.get("openai_responses") or [""])[0] or "").strip()
+            # Failed calls are not cached, the file is summarized again on the next run
+            if not summary:
+                return None, summary
+            self.summary_cache.store(key, summary)
+        return key, summary
+
+    def _roll_up(self, path: str, child_rollups: list) -> tuple:
+        # A None key marks a summary that failed, everything above it is rebuilt and not cached
+        # until the next run fills the gap
+        key = None
+        if all(child_key is not None for _, (child_key, _) in child_rollups):
+            key = _sha256(["directory", _PROMPT_VERSION, self.inputs.get("model"), [
+                [child, child_key] for child, (child_key, _) in child_rollups
+            ]])
+        # A folder with a single entry says what that entry says, no call is needed
+        if len(child_rollups) == 1:
+            return key, child_rollups[0][1][1]
+        summary = self.summary_cache.lookup("directory", key)
+        if summary is None:
+            summaries = "\n\n".join(f"{child}:\n{child_summary}" for child, (_, child_summary) in child_rollups)
+            outputs = self._call_llm("generateREADME_directory", {"path": path, "summaries": summaries})
+            summary = ((outputs.get("openai_responses") or [""])[0] or "").strip()
+            if not summary:
+                return None, summary
+            if key is not None:
+                self.summary_cache.store(key, summary)
+        return key, summary
+
+    def _write_readme(self, root_key: Optional[str], children: dict, rollups: dict) -> dict:
+        readme_path = self.folder_path / self.markdown_file_name
+        key = _sha256(["readme", _PROMPT_VERSION, self.inputs.get("model"), root_key]) if root_key is not None else None
+        if self.summary_cache.lookup("readme", key) is not None and readme_path.is_file():
+            logger.info(f"Nothing changed below {self.folder_path}, {self.markdown_file_name} is kept")
+            self.inputs["modified_code_files"] = []
+            return self.inputs
+
+        # The root summary first, then one section per top level entry
+        sections = [f"Project summary:\n{rollups['.'][1]}"]
+        sections.extend(f"{child}:\n{rollups[child][1]}" for child in children["."])
+        outputs = self._call_llm(
+            self.inputs.get("prompt_id", "generateREADME"),
+            {"fullContent": "\n\n".join(sections)},
+            response_partitions={"patch": []},
+        )
+        self.inputs.update(outputs)
+
+        readme_path.touch()
+        lines = readme_path.read_text().splitlines(keepends=True)
+        self.inputs["files_to_patch"] = [
+            dict(uri=str(readme_path), startLine=0, endLine=len(lines), fullContent=sections[0])
+        ]
+        outputs = self.tracer.run_step(ModifyCode, self.inputs)
+        self.inputs.update(outputs)
+        if key is not None and any(response.get("patch") for response in self.inputs.get("extracted_responses", [])):
+            self.summary_cache.store(key, root_key)
+
+        self.inputs["branch_prefix"] = self.inputs.get("branch_prefix", f"{self.__class__.__name__.lower()}-")
+        self.inputs["pr_title"] = f"PatchWork {self.__class__.__name__}"
+        number = len(self.inputs["modified_code_files"])
+        self.inputs["pr_header"] = f"This pull request from patchwork adds {number} READMEs."
+        # The cache is committed with the README it describes, so the next run on the branch starts from it
+        if self.summary_cache.save() and number > 0:
+            self.inputs["modified_code_files"] = [*self.inputs["modified_code_files"], dict(
+                path=str(self.summary_cache.cache_file.resolve()),
+                commit_message="Record the file and folder summaries of the README in the summary cache",
+            )]
+        outputs = self.tracer.run_step(PR, self.inputs)
+        self.inputs.update(outputs)
+        return self.inputs
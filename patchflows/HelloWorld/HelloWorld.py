@@ -1,19 +1,19 @@
+import sys
 from pathlib import Path
 
-import yaml
-
 from patchwork.step import Step
 
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config  # noqa: E402
+
 _DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
 _DEFAULT_PROMPT_JSON = Path(__file__).parent / "prompt.json"
 
 class HelloWorld(Step):
     def __init__(self, inputs: dict):
-        final_inputs = yaml.safe_load(_DEFAULT_INPUT_FILE.read_text())
-                    
-        if final_inputs is None:
-            final_inputs = {}
-        final_inputs.update(inputs)
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
             
         if "prompt_template_file" not in final_inputs.keys():
             final_inputs["prompt_template_file"] = _DEFAULT_PROMPT_JSON
@@ -0,0 +1,282 @@
+import fnmatch
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from patchwork import patchflows
+from patchwork.logger import logger
+from patchwork.step import Step
+from patchwork.steps import (
+    LLM,
+    CreatePRComment,
+    PreparePR,
+    ReadPRDiffs,
+)
+
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config, load_prompts  # noqa: E402
+from patchflow_tracing import Tracer  # noqa: E402
+
+_DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
+_DEFAULT_PROMPT_JSON = Path(__file__).parent / "prompt.json"
+
+_NONE = "none"
+_SHORT = "short"
+_LONG = "long"
+_SUMMARY_LEVEL = {
+    _NONE: 0,
+    _SHORT: 1,
+    _LONG: 2,
+}
+
+_DEFAULT_MAX_CONCURRENCY = 8
+# Tokens of diff per diffreview call, the prompt around it and the answer need room too
+_DEFAULT_CHUNK_TOKENS = 3000
+_DEFAULT_SUMMARY_FAN_IN = 20
+
+# Lockfiles, build output and code generators, their diffs are large and say little about the change
+_GENERATED_PATTERNS = [
+    "*.min.js", "*.min.css", "*.map", "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.cc", "*.pb.h",
+    "*.generated.*", "*.g.dart", "*.designer.cs", "package-lock.json", "yarn.lock", "pnpm-lock.yaml",
+    "poetry.lock", "Pipfile.lock", "Cargo.lock", "go.sum", "composer.lock", "Gemfile.lock",
+    "dist/*", "build/*", "*/dist/*", "*/build/*",
+]
+_VENDORED_PATTERNS = [
+    "vendor/*", "*/vendor/*", "third_party/*", "*/third_party/*", "node_modules/*", "*/node_modules/*",
+]
+# Markers code generators put at the top of the files they write
+_GENERATED_MARKER_PATTERN = re.compile(r"@generated|Code generated .* DO NOT EDIT|<auto-generated")
+# Files where a change of indentation changes the meaning
+_INDENTATION_SENSITIVE_PATTERNS = [
+    "*.py", "*.pyi", "*.yml", "*.yaml", "Makefile", "*/Makefile", "*.mk", "GNUmakefile", "*/GNUmakefile",
+]
+_HUNK_HEADER_PATTERN = re.compile(r"^@@ .* @@", re.MULTILINE)
+_SUMMARY_PREFIX_PATTERN = re.compile(r"^\s*A\.\s*Summary:\s*", re.IGNORECASE)
+
+
+def _estimate_tokens(text: str) -> int:
+    # About 4 characters per token for code and English, good enough to keep chunks under the context size
+    return len(text) // 4 + 1
+
+
+def _changed_lines(diff: str) -> tuple:
+    removed = []
+    added = []
+    for line in diff.splitlines():
+        if line.startswith(("---", "+++")):
+            continue
+        if line.startswith("-"):
+            removed.append(line[1:])
+        elif line.startswith("+"):
+            added.append(line[1:])
+    return removed, added
+
+
+def _skip_reason(path: str, diff: str, skip_patterns: list, skip_whitespace_only: bool) -> Optional[str]:
+    if any(fnmatch.fnmatch(path, pattern) for pattern in _VENDORED_PATTERNS):
+        return "vendored"
+    if any(fnmatch.fnmatch(path, pattern) for pattern in _GENERATED_PATTERNS):
+        return "generated"
+    if any(fnmatch.fnmatch(path, pattern) for pattern in skip_patterns):
+        return "skip_patterns"
+
+    removed, added = _changed_lines(diff)
+    if not removed and not added:
+        return "empty"
+    if any(_GENERATED_MARKER_PATTERN.search(line) for line in added[:20]):
+        return "generated"
+    if skip_whitespace_only:
+        # Rewrapped or re-line-ended code has the same lines in the same order once whitespace is removed,
+        # where indentation is syntax it has to stay the same too
+        keep_indentation = any(fnmatch.fnmatch(path, pattern) for pattern in _INDENTATION_SENSITIVE_PATTERNS)
+
+        def normalized(lines):
+            normalized_lines = []
+            for line in lines:
+                stripped = "".join(line.split())
+                if not stripped:
+                    continue
+                indentation = line[:len(line) - len(line.lstrip())] if keep_indentation else ""
+                normalized_lines.append(indentation + stripped)
+            return normalized_lines
+
+        if normalized(removed) == normalized(added):
+            return "whitespace only"
+    return None
+
+
+def _split_hunk(hunk: str, max_tokens: int) -> list:
+    """Splits a hunk that is larger than the budget on line boundaries, every piece keeps the hunk header."""
+    header, _, body = hunk.partition("\n")
+    pieces = []
+    lines = []
+    size = _estimate_tokens(header)
+    for line in body.splitlines(keepends=True):
+        line_tokens = _estimate_tokens(line)
+        if lines and size + line_tokens > max_tokens:
+            pieces.append(header + "\n" + "".join(lines))
+            lines = []
+            size = _estimate_tokens(header)
+        lines.append(line)
+        size += line_tokens
+    if lines:
+        pieces.append(header + "\n" + "".join(lines))
+    return pieces
+
+
+def _chunk_diff(diff: str, max_tokens: int) -> list:
+    """Packs the hunks of a file diff into as few chunks under the token budget as possible, in order."""
+    if _estimate_tokens(diff) <= max_tokens:
+        return [diff]
+
+    starts = [match.start() for match in _HUNK_HEADER_PATTERN.finditer(diff)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    hunks = [diff[start:end] for start, end in zip(starts, starts[1:] + [len(diff)]) if diff[start:end].strip()]
+
+    chunks = []
+    current = ""
+    for hunk in hunks:
+        pieces = _split_hunk(hunk, max_tokens) if _estimate_tokens(hunk) > max_tokens else [hunk]
+        for piece in pieces:
+            if current and _estimate_tokens(current + piece) > max_tokens:
+                chunks.append(current)
+                current = ""
+            current += piece if piece.endswith("\n") else piece + "\n"
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class PRReview(Step):
+    def __init__(self, inputs: dict):
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
+
+        if "prompt_template_file" not in final_inputs.keys():
+            final_inputs["prompt_template_file"] = _DEFAULT_PROMPT_JSON
+        # ReadPRDiffs fills the per file prompt, the summary prompt gets the reviews joined together
+        load_prompts(
+            final_inputs["prompt_template_file"],
+            {
+                "diffreview": {"title", "body", "path", "diff", "other_fields"},
+                "diffreview_summary": {"diffreviews"},
+            }
+        )
+
+        diff_summary = final_inputs.get("diff_summary", _LONG)
+        if diff_summary.lower() not in _SUMMARY_LEVEL.keys():
+            raise ValueError(f"Invalid diff_summary, accepted diff_summary values: {_SUMMARY_LEVEL.keys()}")
+        self.verbosity = _SUMMARY_LEVEL[diff_summary.lower()]
+
+        self.inputs = final_inputs
+
+        self.map_reduce = bool(final_inputs.get("map_reduce", False))
+        self.max_concurrency = int(final_inputs.get("review_max_concurrency", _DEFAULT_MAX_CONCURRENCY))
+        self.chunk_tokens = int(final_inputs.get("review_chunk_tokens", _DEFAULT_CHUNK_TOKENS))
+        self.summary_fan_in = max(2, int(final_inputs.get("review_summary_fan_in", _DEFAULT_SUMMARY_FAN_IN)))
+        skip_patterns = final_inputs.get("review_skip_patterns", [])
+        if isinstance(skip_patterns, str):
+            skip_patterns = [pattern.strip() for pattern in skip_patterns.split(",") if pattern.strip()]
+        self.skip_patterns = skip_patterns
+        self.skip_whitespace_only = bool(final_inputs.get("review_skip_whitespace_only", True))
+
+        self.tracer = Tracer.from_inputs(final_inputs)
+
+    def run(self) -> dict:
+        if not self.map_reduce:
+            # One review call per file after another, as the PRReview that ships with patchwork does
+            return patchflows.PRReview(self.inputs).run()
+        if self.verbosity == _SUMMARY_LEVEL[_NONE]:
+            return dict()
+
+        prompt_values = self.tracer.run_step(ReadPRDiffs, self.inputs)["prompt_values"]
+
+        chunks = []
+        skipped = {}
+        for values in prompt_values:
+            reason = _skip_reason(values["path"], values["diff"], self.skip_patterns, self.skip_whitespace_only)
+            if reason is not None:
+                skipped.setdefault(reason, []).append(values["path"])
+                continue
+            file_chunks = _chunk_diff(values["diff"], self.chunk_tokens)
+            for index, diff in enumerate(file_chunks):
+                chunks.append(dict(values, diff=diff, chunk=index, chunks=len(file_chunks)))
+        for reason, paths in skipped.items():
+            logger.info(f"Skipped {len(paths)} {reason} files: {', '.join(paths)}")
+        logger.info(f"Reviewing {len(chunks)} chunks of {len(prompt_values) - sum(map(len, skipped.values()))} files")
+
+        # Map, executor.map keeps the order of the files and their chunks in the PR comment
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            reviews = list(executor.map(self._review_chunk, chunks))
+            summaries = [
+                {"path": chunk["path"], "commit_message": review}
+                for chunk, review in zip(chunks, reviews)
+                if review
+            ]
+
+            # Reduce, groups of reviews are summarized until one summary is left
+            header = ""
+            if self.verbosity > _SUMMARY_LEVEL[_SHORT] and summaries:
+                partials = [f"{summary['path']}: {summary['commit_message']}" for summary in summaries]
+                level = 0
+                while True:
+                    groups = [
+                        partials[i:i + self.summary_fan_in] for i in range(0, len(partials), self.summary_fan_in)
+                    ]
+                    partials = [
+                        partial
+                        for partial in executor.map(lambda group: self._summarize(group, level), groups)
+                        if partial
+                    ]
+                    level += 1
+                    if len(partials) <= 1:
+                        break
+                header = partials[0] if partials else ""
+
+        self.inputs["pr_header"] = header
+        self.inputs["modified_code_files"] = summaries
+        outputs = self.tracer.run_step(PreparePR, self.inputs)
+        self.inputs.update(outputs)
+
+        self.inputs["pr_comment"] = self.inputs["pr_body"]
+        outputs = self.tracer.run_step(CreatePRComment, self.inputs)
+        self.inputs.update(outputs)
+
+        self.tracer.save()
+        self.tracer.print_summary()
+        return self.inputs
+
+    def _review_chunk(self, chunk: dict) -> str:
+        values = {key: chunk[key] for key in ("title", "body", "path", "diff") if key in chunk}
+        values["other_fields"] = ""
+        if chunk["chunks"] > 1:
+            values["path"] = f"{chunk['path']} (part {chunk['chunk'] + 1} of {chunk['chunks']})"
+        try:
+            outputs = self.tracer.run_step(
+                LLM, dict(self.inputs, prompt_id="diffreview", prompt_values=[values]),
+                name="LLM diffreview", path=chunk["path"]
+            )
+        except Exception as e:
+            logger.error(f"Review of {values['path']} failed: {e}")
+            return ""
+        response = (outputs.get("openai_responses") or [""])[0] or ""
+        return _SUMMARY_PREFIX_PATTERN.sub("", response).strip()
+
+    def _summarize(self, partials: list, level: int) -> str:
+        # A partial left over on its own above the first level is already a summary, it moves up unchanged
+        if len(partials) == 1 and level > 0:
+            return partials[0]
+        try:
+            outputs = self.tracer.run_step(
+                LLM,
+                dict(self.inputs, prompt_id="diffreview_summary", prompt_values=[{"diffreviews": "\n".join(partials)}]),
+                name="LLM diffreview_summary", level=level
+            )
+        except Exception as e:
+            logger.error(f"Summary of {len(partials)} reviews failed: {e}")
+            return ""
+        return ((outputs.get("openai_responses") or [""])[0] or "").strip()
@@ -1,9 +1,19 @@
-import yaml
 import os
 import fnmatch
 import json
+import queue
+import re
+import hashlib
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
+from typing import Optional
+from tree_sitter_languages import get_parser
+
 from patchwork.logger import logger
 from patchwork.step import Step
 from patchwork.steps import (
@@ -14,119 +24,696 @@ from patchwork.steps import (
     TsMorph
 )
 
+_COMMON_DIR = str(Path(__file__).resolve().parent.parent / "_common")
+if _COMMON_DIR not in sys.path:
+    sys.path.append(_COMMON_DIR)
+from patchflow_loader import load_config  # noqa: E402
+from patchflow_tracing import Tracer  # noqa: E402
+from llm_cache import LLMCache  # noqa: E402
+
 _DEFAULT_INPUT_FILE = Path(__file__).parent / "config.yml"
 
+_TYPE_SESSION_SCRIPT = Path(__file__).parent / "type_session.js"
+# Seconds to wait for one answer of the type session, the first one includes loading the project
+_DEFAULT_TYPE_SESSION_TIMEOUT = 120
+
+# Bump whenever the extraction or documentation prompts change, so cached docs are regenerated
+_PROMPT_VERSION = "1"
+
+_ENTRY_FILE_NAME = "index"
+_SOURCE_EXTENSIONS = (".tsx", ".ts", ".jsx", ".js")
+# Strings are matched so that comment markers inside them are kept
+_COMMENT_PATTERN = re.compile(
+    r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'|`(?:\\.|[^`\\])*`)|(//[^\n]*|/\*.*?\*/)",
+    re.DOTALL,
+)
+_EXPORT_FROM_PATTERN = re.compile(
+    r"export\s+(?P<type_only>type\s+)?(?:\{(?P<names>[^}]*)\}|\*(?:\s+as\s+(?P<namespace>\w+))?)\s*"
+    r"from\s*['\"](?P<module>[^'\"]+)['\"]"
+)
+_EXPORT_LOCAL_LIST_PATTERN = re.compile(r"export\s+(?P<type_only>type\s+)?\{(?P<names>[^}]*)\}(?!\s*from)")
+_IMPORT_PATTERN = re.compile(
+    r"(?:\bfrom\s*|\bimport\s*\(?\s*|\brequire\s*\(\s*)['\"](?P<module>\.[^'\"]*)['\"]"
+)
+
+
+def _strip_comments(content: str) -> str:
+    return _COMMENT_PATTERN.sub(lambda match: match.group(1) or " ", content)
+
+
+def _parse_export_names(names: str) -> list:
+    """
+    Parses the inside of an export list into (exported name, local name) pairs, type only specifiers are skipped.
+    """
+    pairs = []
+    for specifier in names.split(","):
+        specifier = specifier.strip()
+        if specifier == "" or specifier.startswith("type "):
+            continue
+        local_name, _, exported_name = specifier.partition(" as ")
+        local_name = local_name.strip()
+        exported_name = exported_name.strip() or local_name
+        # For `default as Name` the declaration in the file is most likely called Name as well
+        pairs.append((exported_name, exported_name if local_name == "default" else local_name))
+    return pairs
+
+
+class _ExportIndexer:
+    """
+    Builds the export name to file map of an SDK from its entry file, following `export ... from` and
+    recursively expanding `export *` re-exports.
+    """
+
+    def __init__(self, src_folder: str):
+        self.src_folder = Path(src_folder)
+        # Index of the source tree built once, module resolution only does set lookups
+        self.files = {
+            Path(root) / file_name
+            for root, _, file_names in os.walk(self.src_folder)
+            for file_name in file_names
+            if file_name.endswith(_SOURCE_EXTENSIONS)
+        }
+
+    def resolve(self, base: Path):
+        if base in self.files:
+            return base
+        for extension in _SOURCE_EXTENSIONS:
+            candidate = base.with_name(base.name + extension)
+            if candidate in self.files:
+                return candidate
+        for extension in _SOURCE_EXTENSIONS:
+            candidate = base / f"{_ENTRY_FILE_NAME}{extension}"
+            if candidate in self.files:
+                return candidate
+        return None
+
+    def dependents(self, changed_files: set) -> set:
+        """
+        Returns the changed files plus every file that imports one of them, directly or transitively.
+        """
+        importers = defaultdict(set)
+        for file_path in self.files:
+            content = _strip_comments(file_path.read_text())
+            for match in _IMPORT_PATTERN.finditer(content):
+                target = self.resolve(Path(os.path.normpath(file_path.parent / match.group("module"))))
+                if target is not None:
+                    importers[target].add(file_path)
+
+        affected = set(changed_files)
+        pending = list(changed_files)
+        while pending:
+            for importer in importers[pending.pop()]:
+                if importer not in affected:
+                    affected.add(importer)
+                    pending.append(importer)
+        return affected
+
+    def index_entry(self) -> list:
+        entry_file = self.resolve(self.src_folder / _ENTRY_FILE_NAME)
+        if entry_file is None:
+            raise ValueError(f"No {_ENTRY_FILE_NAME} file found in {self.src_folder}")
+
+        exports = {}
+        self._collect(entry_file, exports, set(), is_entry=True)
+        return [
+            dict(name=name, variable_name=local_name, file_path=str(file_path))
+            for name, (local_name, file_path) in exports.items()
+        ]
+
+    def _collect(self, file_path: Path, exports: dict, visited: set, is_entry: bool = False) -> None:
+        if file_path in visited:
+            return
+        visited.add(file_path)
+
+        content = _strip_comments(file_path.read_text())
+        for match in _EXPORT_FROM_PATTERN.finditer(content):
+            if match.group("type_only"):
+                continue
+            module = match.group("module")
+            if not module.startswith("."):
+                logger.debug(f"Skipping re-export from package {module} in {file_path}")
+                continue
+            target = self.resolve(Path(os.path.normpath(file_path.parent / module)))
+            if target is None:
+                logger.warning(f"Could not resolve {module} exported from {file_path}")
+                continue
+
+            if match.group("names") is not None:
+                for exported_name, local_name in _parse_export_names(match.group("names")):
+                    exports.setdefault(exported_name, (local_name, target))
+            elif match.group("namespace") is not None:
+                exports.setdefault(match.group("namespace"), (match.group("namespace"), target))
+            else:
+                self._collect(target, exports, visited)
+
+        # Declarations are only documented when they are reached through `export *`,
+        # the entry file itself is expected to only re-export
+        if is_entry:
+            return
+        for name in _exported_declaration_names(content, file_path):
+            exports.setdefault(name, (name, file_path))
+        for match in _EXPORT_LOCAL_LIST_PATTERN.finditer(content):
+            if match.group("type_only"):
+                continue
+            for exported_name, local_name in _parse_export_names(match.group("names")):
+                exports.setdefault(exported_name, (local_name, file_path))
+
+
+# Angle bracket casts like `<Type>value` are only valid in .ts files, the tsx grammar reads them as JSX
+_GRAMMARS = {
+    ".ts": "typescript",
+    ".mts": "typescript",
+    ".cts": "typescript",
+    ".tsx": "tsx",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".mjs": "javascript",
+    ".cjs": "javascript",
+}
+
+_SLICEABLE_DECLARATIONS = {
+    "function_declaration",
+    "generator_function_declaration",
+    "class_declaration",
+    "abstract_class_declaration",
+    "lexical_declaration",
+    "variable_declaration",
+    "ambient_declaration",
+}
+
+
+def _declared_names(declaration) -> list:
+    if declaration.type == "ambient_declaration":
+        # `declare const a: A, b: B` wraps the declaration it makes
+        return [name for child in declaration.named_children for name in _declared_names(child)]
+    if declaration.type in ("lexical_declaration", "variable_declaration"):
+        return [
+            child.child_by_field_name("name").text.decode()
+            for child in declaration.children
+            if child.type == "variable_declarator"
+        ]
+    name = declaration.child_by_field_name("name")
+    return [name.text.decode()] if name is not None else []
+
+
+def _parse(source: bytes, file_path):
+    return get_parser(_GRAMMARS.get(Path(file_path).suffix.lower(), "tsx")).parse(source).root_node
+
+
+def _exported_declaration_names(content: str, file_path) -> list:
+    """
+    Returns the names of the declarations exported where they are declared, every declarator
+    of `export const a = 1, b = () => {}` included.
+    """
+    root = _parse(content.encode(), file_path)
+    names = []
+    for node in root.children:
+        declaration = node.child_by_field_name("declaration") if node.type == "export_statement" else None
+        if declaration is not None and declaration.type in _SLICEABLE_DECLARATIONS:
+            names.extend(_declared_names(declaration))
+    return names
+
+
+def _slice_export(content: str, name: str, file_path) -> Optional[str]:
+    """
+    Returns the exact source of the top level declaration called name, sliced out of the file buffer
+    with the byte offsets of its node in the syntax tree. Exported declarations are preferred over
+    local ones that are exported later through an export list.
+    """
+    source = content.encode()
+    root = _parse(source, file_path)
+    local_declaration = None
+    for node in root.children:
+        declaration = node.child_by_field_name("declaration") if node.type == "export_statement" else node
+        if declaration is None or declaration.type not in _SLICEABLE_DECLARATIONS:
+            continue
+        if name not in _declared_names(declaration):
+            continue
+        if node.type == "export_statement":
+            return source[node.start_byte:node.end_byte].decode()
+        if local_declaration is None:
+            local_declaration = source[node.start_byte:node.end_byte].decode()
+    return local_declaration
+
+
+def _sha256(value) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class _DocsCache:
+    """
+    Remembers per export the hash of everything its doc was generated from, so unchanged exports can skip the LLM.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = Path(cache_file)
+        self._entries = json.loads(self.cache_file.read_text()) if self.cache_file.is_file() else {}
+        self._lock = threading.Lock()
+        self.hits = []
+        self.misses = []
+
+    @staticmethod
+    def key(name: str, source: str, type_information, model: str) -> str:
+        return _sha256([name, _sha256(source), _sha256(type_information), _PROMPT_VERSION, model])
+
+    def lookup(self, name: str, key: str) -> bool:
+        entry = self._entries.get(name)
+        # The doc page may have been removed since it was generated
+        is_hit = entry is not None and entry["key"] == key and Path(entry["doc_path"]).is_file()
+        with self._lock:
+            (self.hits if is_hit else self.misses).append(name)
+        return is_hit
+
+    def store(self, name: str, key: str, doc_path: str) -> None:
+        with self._lock:
+            self._entries[name] = {"key": key, "doc_path": doc_path}
+
+    def save(self) -> bool:
+        """Writes the cache file, returns whether its content changed."""
+        content = json.dumps(self._entries, indent=2, sort_keys=True)
+        if self.cache_file.is_file() and self.cache_file.read_text() == content:
+            return False
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        tmp_file.write_text(content)
+        os.replace(tmp_file, self.cache_file)
+        return True
+
+    def print_report(self) -> None:
+        print(f"\nDocs cache: {len(self.hits)} unchanged, {len(self.misses)} regenerated")
+        for name in sorted(self.misses):
+            print(f"  regenerated {name}")
+
+
+class _TypeAnalysisSession:
+    """
+    Keeps one ts-morph project loaded in a node subprocess and queries it over stdin/stdout,
+    so the SDK is parsed once instead of once per export.
+    """
+
+    def __init__(self, project_root: str, timeout: float = _DEFAULT_TYPE_SESSION_TIMEOUT):
+        self._process = subprocess.Popen(
+            ["node", str(_TYPE_SESSION_SCRIPT), project_root],
+            cwd=project_root,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        # Lines are read on a thread of their own, so a query can stop waiting for a session that hangs
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+
+    def _read_lines(self) -> None:
+        try:
+            for line in self._process.stdout:
+                self._lines.put(line)
+        except (OSError, ValueError):
+            # ValueError when stdout is closed while it is read
+            pass
+        self._lines.put("")
+
+    def query(self, file_path: str, names: list) -> dict:
+        """
+        Returns the type information of every name in file_path in one round trip, None for names not found.
+        """
+        with self._lock:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"The type analysis session exited with code {self._process.returncode}")
+            try:
+                self._process.stdin.write(json.dumps({"file_path": file_path, "names": names}) + "\n")
+                self._process.stdin.flush()
+            except OSError as e:
+                # BrokenPipeError when node exited, for example because ts-morph is not installed
+                raise RuntimeError(f"The type analysis session exited unexpectedly: {e}") from e
+            try:
+                line = self._lines.get(timeout=self._timeout)
+            except queue.Empty:
+                # A late answer would be taken for the one of the next query, so the session is not reused
+                self._process.kill()
+                self._process.wait()
+                raise RuntimeError(f"The type analysis session did not answer within {self._timeout}s")
+
+        if line == "":
+            raise RuntimeError("The type analysis session exited unexpectedly")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Type analysis of {file_path} failed: {response['error']}")
+        return response["type_information"]
+
+    def close(self) -> None:
+        # Safe to call more than once and after the process has already exited
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+
+
+# Static instructions lead every MDX prompt so they form a byte identical prefix across requests,
+# which lets providers with prompt prefix caching reuse it instead of reprocessing it per export
+_MDX_INSTRUCTIONS = """# Task: Generate Concise MDX Documentation for @stackframe/stack SDK Exports
+
+You are a technical writer. Create concise MDX documentation for a given exported type or method from the @stackframe/stack SDK, focusing solely on its interface and usage. Follow these steps:
+
+1. Analyze the provided code snippet and type information, noting parameter types and optionality.
+2. Generate brief MDX documentation explaining how to use the exported type or method.
+3. Use consistent and simple language throughout.
+4. Determine the appropriate file name based on the export name.
+5. Create a JSON object with the file path, line numbers, and documentation content as new_code.
+
+## Input Variables
+
+- {code_snippet}: The full code of the exported type or method
+- {sdk_docs_folder}: The base path for the documentation files
+- {type_information}: Detailed type information obtained from tsx-morph analysis
+
+## Output Format
+
+Provide your response in the following JSON format only:
+
+{
+  "file_path": "string",
+  "start_line": number,
+  "end_line": number,
+  "new_code": "string"
+}
+
+## Rules
+
+1. Use kebab-case for the file name with an .mdx suffix.
+2. Construct file_path by joining sdk_docs_folder and the file name.
+3. Include the full MDX content in the new_code, including frontmatter.
+4. Use simple language. Avoid buzzwords and complex terms.
+5. Focus only on interface information: brief description, parameters, and a basic usage example.
+6. Omit implementation details.
+7. Document all parameters and types accurately, indicating optional parameters.
+8. If the function outputs a tsx component, ignore the top level `props` argument, and instead describe the component's props in a "Props" heading.
+9. Use 0 for start_line, and total lines minus 1 for end_line (zero-based indexing).
+10. Always import from "@stackframe/stack" in examples.
+11. Use single quotes in documentation and examples.
+12. Use ```tsx for all code blocks.
+13. Carefully identify and document optional parameters.
+14. Show usage with and without optional parameters when applicable.
+15. Do not include any additional paragraphs or sections after the example.
+16. Utilize the type_information to provide accurate and detailed type descriptions.
+
+## MDX Content Structure
+
+1. Frontmatter with title (camelCase name of the export)
+2. # Heading (export name)
+3. Brief description (1-2 sentences max)
+4. ## Parameters (if applicable)
+5. ## Props (if applicable)
+6. ## Example
+7. End the documentation after the example. Do not add any concluding paragraphs or notes.
+
+## Example
+
+For this input:
+
+{code_snippet} = ```
+export function calculateTotalPrice(items: Item[], discountCode?: string): number {
+  let total = items.reduce((sum, item) => sum + item.price, 0);
+  if (discountCode) {
+    total *= 0.9; // 10% discount
+  }
+  return total;
+}
+```
+
+{sdk_docs_folder} = "/docs/sdk"
+
+{type_information} = ```
+{
+  "kind": "FunctionDeclaration",
+  "name": "calculateTotalPrice",
+  "parameters": [
+    {
+      "name": "items",
+      "type": "Item[]",
+      "isOptional": false
+    },
+    {
+      "name": "discountCode",
+      "type": "string",
+      "isOptional": true
+    }
+  ],
+  "returnType": "number"
+}
+```
+
+Your output should be:
+
+{
+  "file_path": "/docs/sdk/calculate-total-price.mdx",
+  "start_line": 0,
+  "end_line": 22,
+  "new_code": "---\\ntitle: calculateTotalPrice\\n---\\n\\n# calculateTotalPrice\\n\\nCalculates the total price of items, with an optional discount. Returns a number representing the total price.\\n\\n## Parameters\\n\\n- `items`: `Item[]` - An array of items to calculate the total price for. Each item must have a `price` property.\\n- `discountCode` (optional): `string` - A code to apply a 10% discount to the total price.\\n\\n## Example\\n\\n```tsx\\nimport { calculateTotalPrice } from '@stackframe/stack';\\n\\nconst items = [\\n  { price: 10 },\\n  { price: 20 },\\n  { price: 30 }\\n];\\n\\n// Without discount\\nconst total = calculateTotalPrice(items);\\n\\n// With discount\\nconst discountedTotal = calculateTotalPrice(items, 'DISCOUNT10');\\n```"
+}
+
+"""
+
+
+_MDX_BATCH_INSTRUCTIONS = """## Batch Output Format
+
+You will receive several exported code snippets, each introduced by an "### Export: <name>" heading with its own type information. Document every one of them following the rules above, and provide your response in the following JSON format only, with exactly one item per export in the order given:
+
+{
+  "docs": [
+    {
+      "name": "string (the export name from its heading)",
+      "file_path": "string",
+      "start_line": number,
+      "end_line": number,
+      "new_code": "string"
+    }
+  ]
+}
+
+"""
+
+_DOC_KEYS = ("file_path", "start_line", "end_line", "new_code")
+
+
+def _is_valid_doc(item) -> bool:
+    if not isinstance(item, dict) or not isinstance(item.get("name"), str):
+        return False
+    return _is_valid_doc_output(item)
+
+
+def _is_valid_doc_output(item) -> bool:
+    if not isinstance(item, dict):
+        return False
+    if not isinstance(item.get("file_path"), str) or not item["file_path"]:
+        return False
+    if not isinstance(item.get("new_code"), str) or not item["new_code"]:
+        return False
+    lines = [item.get("start_line"), item.get("end_line")]
+    if not all(isinstance(line, int) and not isinstance(line, bool) for line in lines):
+        return False
+    return 0 <= lines[0] <= lines[1]
+
+
+def _is_valid_docs_batch(response) -> bool:
+    items = response.get("docs") if isinstance(response, dict) else None
+    return isinstance(items, list) and len(items) > 0 and all(_is_valid_doc(item) for item in items)
+
+
 class UpdateSDKDocs(Step):
     def __init__(self, inputs: dict):
-        final_inputs = yaml.safe_load(_DEFAULT_INPUT_FILE.read_text())
-                    
-        if final_inputs is None:
-            final_inputs = {}
-        final_inputs.update(inputs)
+        final_inputs = load_config(_DEFAULT_INPUT_FILE, inputs)
         
         self.inputs = final_inputs
 
+        self.docs_cache = None
+        if "docs_cache_file" in final_inputs:
+            self.docs_cache = _DocsCache(final_inputs["docs_cache_file"])
+
+        self.type_informations = {}
+        self.tracer = Tracer.from_inputs(final_inputs)
+
+        self.llm_step = SimplifiedLLMOnce
+        self.doc_llm_step = SimplifiedLLMOnce
+        self.batch_llm_step = SimplifiedLLMOnce
+        self.llm_cache = LLMCache.from_inputs(final_inputs)
+        if self.llm_cache is not None:
+            self.llm_step = self.llm_cache.wrap(SimplifiedLLMOnce)
+            # Malformed docs are not cached, so a rerun asks the model again instead of replaying them
+            self.doc_llm_step = self.llm_cache.wrap(SimplifiedLLMOnce, is_valid=_is_valid_doc_output)
+            self.batch_llm_step = self.llm_cache.wrap(SimplifiedLLMOnce, is_valid=_is_valid_docs_batch)
+
     def run(self) -> dict:
         # Get the absolute path of the folder
         abs_path = os.path.abspath(self.inputs["sdk_src_folder"])
         sdk_path = os.path.abspath(self.inputs["sdk_docs_folder"])
         responses = {}
-        all_docs = []
         # Check if the folder exists
         if not os.path.exists(abs_path):
-            print(f"The folder '{self.inputs["sdk_src_folder"]}' does not exist.")
+            print(f"The folder '{self.inputs['sdk_src_folder']}' does not exist.")
             return
         
         # Convert the file pattern string to a list
         file_patterns = [pattern.strip() for pattern in self.inputs["filter"].split(',')]
-        self.inputs["file_path"] = abs_path + "/index.tsx"
-        index_file_content = ReadFile(self.inputs).run()["file_content"]
+        with self.tracer.span("index_exports"):
+            indexer = _ExportIndexer(abs_path)
+            exported_types = indexer.index_entry()
+        if "base_ref" in self.inputs:
+            with self.tracer.span("git diff"):
+                exported_types = self._filter_changed_exports(indexer, exported_types, abs_path, file_patterns)
         self.inputs["prompt_value"] = {}
-        prompt = f"""You are an AI assistant designed to parse JavaScript/TypeScript export statements and generate a JSON output. Your task is to analyze the contents of a file containing export statements and create a structured JSON representation of the exported types and their file paths.
-
-Input:
-1. A `base_path` string that represents the root directory for the file paths.
-2. The contents of a file containing export statements.
-
-Your task is to:
-1. Parse each export statement in the file.
-2. Extract the names of the exported types and the file paths they are exported from.
-3. Combine the `base_path` with the relative path in the export statement to create the full file path.
-4. Generate a JSON output with an "exported_types" array containing objects with "name" and "file_path" properties for each exported type.
-
-Rules for parsing:
-1. For named exports like `export {{ A, B }} from "./path/to/file"`, create an entry for each exported name.
-2. For default exports like `export {{ default as Name }} from "./path/to/file"`, create an entry for the renamed default export.
-3. For star exports like `export * from './lib/stack-app'`, do not create any entries (as we can't determine specific type names).
-4. For direct exports like `export {{ Name }}` without a `from` clause, skip the entry (as we don't have path information).
-5. Assume all files are TypeScript (.tsx) unless explicitly stated otherwise in the path.
-
-Output format:
-{{
-  "exported_types": [
-    {{
-      "name": "ExportedTypeName",
-      "file_path": "full/path/to/file.tsx"
-    }}
-  ]
-}}
-
-IMPORTANT: Your response must be ONLY the JSON object in the exact format shown above. Do not include any explanations, comments, or additional text. The JSON should be valid and parseable.
-
-Example input:
-base_path: "/src/components"
-File contents:
-```
-export {{ default as StackProvider }} from "./providers/stack-provider";
-export {{ useUser, useStackApp }} from "./lib/hooks";
-export * from './lib/stack-app';
-export {{ SignIn }} from "./components-page/sign-in";
-```
-
-Example output:
-{{
-  "exported_types": [
-    {{
-      "name": "StackProvider",
-      "file_path": "/src/components/providers/stack-provider.tsx"
-    }},
-    {{
-      "name": "useUser",
-      "file_path": "/src/components/lib/hooks.tsx"
-    }},
-    {{
-      "name": "useStackApp",
-      "file_path": "/src/components/lib/hooks.tsx"
-    }},
-    {{
-      "name": "SignIn",
-      "file_path": "/src/components/components-page/sign-in.tsx"
-    }}
-  ]
-}}
-
-Now, parse the following file and generate the JSON output:
+        if self.inputs.get("type_session", False):
+            with self.tracer.span("type_session"):
+                self._load_type_informations(abs_path, exported_types)
+
+        max_concurrent_exports = int(self.inputs.get("max_concurrent_exports", 1))
+        export_batch_size = int(self.inputs.get("export_batch_size", 1))
+        with ThreadPoolExecutor(max_workers=max_concurrent_exports) as executor:
+            # map keeps the order of exported_types, so the PR lists the docs in a deterministic order
+            if export_batch_size > 1:
+                prepared_exports = [
+                    prepared for prepared in executor.map(self._prepare_export, exported_types)
+                    if prepared is not None
+                ]
+                batches = [
+                    prepared_exports[i:i + export_batch_size]
+                    for i in range(0, len(prepared_exports), export_batch_size)
+                ]
+                all_docs = [
+                    doc
+                    for docs in executor.map(lambda batch: self._document_batch(batch, sdk_path), batches)
+                    for doc in docs
+                ]
+            else:
+                all_docs = list(executor.map(
+                    lambda exported_type: self._document_export(exported_type, sdk_path),
+                    exported_types
+                ))
+
+        # Exports served from the docs cache have nothing to commit
+        modified_code_files = [doc for doc in all_docs if doc is not None]
+        number = len(modified_code_files)
+        if self.docs_cache is not None:
+            # The cache is committed with the docs it describes, so the next run on the branch starts from it
+            if self.docs_cache.save() and number > 0:
+                modified_code_files.append(dict(
+                    path=str(self.docs_cache.cache_file.resolve()),
+                    commit_message=f"Record the inputs of the {number} regenerated docs in the docs cache",
+                ))
+            self.docs_cache.print_report()
+        if self.llm_cache is not None:
+            self.llm_cache.evict()
+            self.llm_cache.print_stats()
+
+        self.inputs["modified_code_files"] = modified_code_files
+        self.inputs["pr_title"] = "Patchwork PR for Updating SDK Docs with Claude"
+        self.inputs["pr_header"] = f"This pull request from patchwork updates {number} SDK Docs"
+        outputs = self.tracer.run_step(PR, self.inputs)
 
-base_path: {abs_path}
-file_content:
-{index_file_content}
-"""
-        self.inputs["prompt_user"] = prompt
-        response = SimplifiedLLMOnce(self.inputs).run()["extracted_response"]
-        exported_types = response["exported_types"]
+        self.tracer.save()
+        self.tracer.print_summary()
+        return outputs
 
+    def _filter_changed_exports(
+        self, indexer: _ExportIndexer, exported_types: list, abs_path: str, file_patterns: list
+    ) -> list:
+        base_ref = self.inputs["base_ref"]
+        # --relative limits the diff to the SDK folder and prints paths relative to it
+        diff = subprocess.run(
+            ["git", "diff", "--name-only", "--relative", base_ref],
+            cwd=abs_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        changed_files = {
+            Path(abs_path) / line
+            for line in diff.stdout.splitlines()
+            if any(fnmatch.fnmatch(Path(line).name, pattern) for pattern in file_patterns)
+        }
+        affected_files = indexer.dependents(changed_files)
+
+        changed_exports = [
+            exported_type for exported_type in exported_types
+            if Path(exported_type["file_path"]) in affected_files
+        ]
+        print(f"{len(changed_exports)} of {len(exported_types)} exports are affected by changes since {base_ref}")
+        return changed_exports
+
+    def _load_type_informations(self, abs_path: str, exported_types: list) -> None:
+        names_by_file = defaultdict(list)
         for exported_type in exported_types:
-            self.inputs["file_path"] = exported_type["file_path"]
-            name = exported_type["name"]
-            self.inputs["variable_name"] = name
-            # print(type_information)
-            # exit(0)
-            content = ReadFile(self.inputs).run()["file_content"]
-            if content == "":
-                self.inputs["file_path"] = self.inputs["file_path"][:-1]
-                content = ReadFile(self.inputs).run()["file_content"]
-            type_information = TsMorph(self.inputs).run()["type_information"]
-            self.inputs["prompt_user"] = f"""# Task: Extract Specific Named Exported Code Element
+            names_by_file[exported_type["file_path"]].append(exported_type["variable_name"])
+
+        try:
+            session = _TypeAnalysisSession(
+                abs_path, float(self.inputs.get("type_session_timeout", _DEFAULT_TYPE_SESSION_TIMEOUT))
+            )
+        except OSError as e:
+            # FileNotFoundError when node is not installed, every export then goes through TsMorph
+            logger.warning(f"Unable to start the type analysis session: {e}, falling back to TsMorph")
+            return
+        try:
+            for file_path, names in names_by_file.items():
+                try:
+                    with self.tracer.span("type_session.query", file=file_path):
+                        type_informations = session.query(file_path, names)
+                except (RuntimeError, OSError) as e:
+                    logger.warning(f"{e}, falling back to TsMorph for its exports")
+                    continue
+                for name, type_information in type_informations.items():
+                    if type_information is not None:
+                        self.type_informations[(file_path, name)] = type_information
+        finally:
+            session.close()
+
+    def _document_export(self, exported_type: dict, sdk_path: str) -> Optional[dict]:
+        prepared = self._prepare_export(exported_type)
+        if prepared is None:
+            return None
+        return self._apply_doc(prepared, self._write_doc(prepared, sdk_path))
+
+    def _document_batch(self, batch: list, sdk_path: str) -> list:
+        outputs = self._write_docs_batch(batch, sdk_path)
+        return [self._apply_doc(prepared, output) for prepared, output in zip(batch, outputs)]
+
+    def _prepare_export(self, exported_type: dict) -> Optional[dict]:
+        # Every export works on its own copy of the inputs so exports can run concurrently
+        inputs = dict(self.inputs)
+        inputs["file_path"] = exported_type["file_path"]
+        name = exported_type["name"]
+        variable_name = exported_type["variable_name"]
+        inputs["variable_name"] = variable_name
+        # print(type_information)
+        # exit(0)
+        content = self.tracer.run_step(ReadFile, inputs, export=name)["file_content"]
+        type_information = self.type_informations.get((exported_type["file_path"], variable_name))
+        if type_information is None:
+            type_information = self.tracer.run_step(TsMorph, inputs, export=name)["type_information"]
+        code_snippet = _slice_export(content, variable_name, exported_type["file_path"])
+
+        cache_key = None
+        if self.docs_cache is not None:
+            source = code_snippet if code_snippet is not None else content
+            cache_key = _DocsCache.key(name, source, type_information, inputs.get("model"))
+            if self.docs_cache.lookup(name, cache_key):
+                return None
+
+        if code_snippet is not None:
+            export = {"export": code_snippet}
+        else:
+            # Declarations the syntax tree lookup does not cover are still extracted by the LLM
+            inputs["prompt_user"] = f"""# Task: Extract Specific Named Exported Code Element
 
 You are a precise code analyzer. Your task is to examine the provided code snippet and extract a specific named exported component, class, or method as a complete code snippet. Follow these steps:
 
@@ -233,16 +820,16 @@ If the provided name is "ProcessUser", your output should be:
 
 Now, analyze the following code snippet and provide the output in the specified JSON format, extracting only the export that matches the provided name:
 
-Name to extract: {name}
+Name to extract: {variable_name}
 
 Code content:
 {content}
 """               
-#                         response = SimplifiedLLMOnce(self.inputs).run()["extracted_response"]
+#                         response = SimplifiedLLMOnce(inputs).run()["extracted_response"]
 #                         exports = response["exports"]
 #                         # print(exports)
 #                         # exit()
-#                         self.inputs["prompt_user"] = f"""# Task: Filter Explicit Exports
+#                         inputs["prompt_user"] = f"""# Task: Filter Explicit Exports
 
 # You are a precise code filter. Your task is to examine the provided list of exported code elements and filter out any that do not explicitly begin with the word "export". Follow these steps:
 
@@ -335,131 +922,83 @@ Code content:
 
 # {exports}
 # """
-            export = SimplifiedLLMOnce(self.inputs).run()['extracted_response']
-            # for export in exports["exports"]:
-            self.inputs["prompt_user"] = f"""# Task: Generate Concise MDX Documentation for @stackframe/stack SDK Exports
-
-You are a technical writer. Create concise MDX documentation for a given exported type or method from the @stackframe/stack SDK, focusing solely on its interface and usage. Follow these steps:
-
-1. Analyze the provided code snippet and type information, noting parameter types and optionality.
-2. Generate brief MDX documentation explaining how to use the exported type or method.
-3. Use consistent and simple language throughout.
-4. Determine the appropriate file name based on the export name.
-5. Create a JSON object with the file path, line numbers, and documentation content as new_code.
-
-## Input Variables
-
-- {{code_snippet}}: The full code of the exported type or method
-- {{sdk_docs_folder}}: The base path for the documentation files
-- {{type_information}}: Detailed type information obtained from tsx-morph analysis
-
-## Output Format
-
-Provide your response in the following JSON format only:
-
-{{
-  "file_path": "string",
-  "start_line": number,
-  "end_line": number,
-  "new_code": "string"
-}}
+            export = self.tracer.run_step(
+                self.llm_step, inputs, name="SimplifiedLLMOnce extract", export=name
+            )['extracted_response']
+        # for export in exports["exports"]:
+        return {
+            "name": name,
+            "inputs": inputs,
+            "export": export,
+            "type_information": type_information,
+            "cache_key": cache_key,
+        }
+
+    def _write_doc(self, prepared: dict, sdk_path: str) -> dict:
+        inputs = prepared["inputs"]
+        inputs["prompt_user"] = _MDX_INSTRUCTIONS + f"""Now, generate the MDX documentation for the following exported code snippet:
+
+{prepared["export"]}
 
-## Rules
-
-1. Use kebab-case for the file name with an .mdx suffix.
-2. Construct file_path by joining sdk_docs_folder and the file name.
-3. Include the full MDX content in the new_code, including frontmatter.
-4. Use simple language. Avoid buzzwords and complex terms.
-5. Focus only on interface information: brief description, parameters, and a basic usage example.
-6. Omit implementation details.
-7. Document all parameters and types accurately, indicating optional parameters.
-8. If the function outputs a tsx component, ignore the top level `props` argument, and instead describe the component's props in a "Props" heading.
-9. Use 0 for start_line, and total lines minus 1 for end_line (zero-based indexing).
-10. Always import from "@stackframe/stack" in examples.
-11. Use single quotes in documentation and examples.
-12. Use ```tsx for all code blocks.
-13. Carefully identify and document optional parameters.
-14. Show usage with and without optional parameters when applicable.
-15. Do not include any additional paragraphs or sections after the example.
-16. Utilize the type_information to provide accurate and detailed type descriptions.
-
-## MDX Content Structure
-
-1. Frontmatter with title (camelCase name of the export)
-2. # Heading (export name)
-3. Brief description (1-2 sentences max)
-4. ## Parameters (if applicable)
-5. ## Props (if applicable)
-6. ## Example
-7. End the documentation after the example. Do not add any concluding paragraphs or notes.
-
-## Example
-
-For this input:
-
-{{code_snippet}} = ```
-export function calculateTotalPrice(items: Item[], discountCode?: string): number {{
-  let total = items.reduce((sum, item) => sum + item.price, 0);
-  if (discountCode) {{
-    total *= 0.9; // 10% discount
-  }}
-  return total;
-}}
-```
-
-{{sdk_docs_folder}} = "/docs/sdk"
-
-{{type_information}} = ```
-{{
-  "kind": "FunctionDeclaration",
-  "name": "calculateTotalPrice",
-  "parameters": [
-    {{
-      "name": "items",
-      "type": "Item[]",
-      "isOptional": false
-    }},
-    {{
-      "name": "discountCode",
-      "type": "string",
-      "isOptional": true
-    }}
-  ],
-  "returnType": "number"
-}}
-```
-
-Your output should be:
+Base path for the documentation:
 
-{{
-  "file_path": "/docs/sdk/calculate-total-price.mdx",
-  "start_line": 0,
-  "end_line": 22,
-  "new_code": "---\\ntitle: calculateTotalPrice\\n---\\n\\n# calculateTotalPrice\\n\\nCalculates the total price of items, with an optional discount. Returns a number representing the total price.\\n\\n## Parameters\\n\\n- `items`: `Item[]` - An array of items to calculate the total price for. Each item must have a `price` property.\\n- `discountCode` (optional): `string` - A code to apply a 10% discount to the total price.\\n\\n## Example\\n\\n```tsx\\nimport {{ calculateTotalPrice }} from '@stackframe/stack';\\n\\nconst items = [\\n  {{ price: 10 }},\\n  {{ price: 20 }},\\n  {{ price: 30 }}\\n];\\n\\n// Without discount\\nconst total = calculateTotalPrice(items);\\n\\n// With discount\\nconst discountedTotal = calculateTotalPrice(items, 'DISCOUNT10');\\n```"
-}}
+{sdk_path}
 
-Now, generate the MDX documentation for the following exported code snippet:
+Type information:
 
-{export}
+{prepared["type_information"]}
+"""
+        return self.tracer.run_step(
+            self.doc_llm_step, inputs, name="SimplifiedLLMOnce mdx", export=prepared["name"]
+        )["extracted_response"]
 
-Base path for the documentation:
+    def _write_docs_batch(self, batch: list, sdk_path: str) -> list:
+        inputs = dict(self.inputs)
+        snippets = "\n".join(
+            f"""### Export: {prepared["name"]}
 
-{sdk_path}
+{prepared["export"]}
 
 Type information:
 
-{type_information}
+{prepared["type_information"]}
 """
-            output = SimplifiedLLMOnce(self.inputs).run()["extracted_response"]
-            self.inputs.update(output) 
-            modified_code_files = ModifyCodePB(self.inputs).run()
-            all_docs.append(modified_code_files)
-            # break
-
-        self.inputs["modified_code_files"] = all_docs
-        number = len(self.inputs["modified_code_files"])
-        self.inputs["pr_title"] = "Patchwork PR for Updating SDK Docs with Claude"
-        self.inputs["pr_header"] = f"This pull request from patchwork updates {number} SDK Docs"
-        outputs = PR(self.inputs).run()
+            for prepared in batch
+        )
+        inputs["prompt_user"] = _MDX_INSTRUCTIONS + _MDX_BATCH_INSTRUCTIONS + f"""Base path for the documentation:
 
+{sdk_path}
+
+Now, generate the MDX documentation for the following {len(batch)} exported code snippets:
+
+{snippets}"""
+        docs = {}
+        try:
+            response = self.tracer.run_step(
+                self.batch_llm_step, inputs, name="SimplifiedLLMOnce batch",
+                export=",".join(prepared["name"] for prepared in batch)
+            )["extracted_response"]
+            items = response.get("docs") if isinstance(response, dict) else None
+            for item in items if isinstance(items, list) else []:
+                if _is_valid_doc(item) and item.get("name") not in docs:
+                    docs[item["name"]] = {key: item[key] for key in _DOC_KEYS}
+        except Exception as e:
+            logger.warning(f"Batched documentation request failed: {e}")
+
+        outputs = []
+        for prepared in batch:
+            output = docs.get(prepared["name"])
+            if output is None:
+                # Missing or malformed items are retried on their own instead of failing the whole batch
+                logger.info(f"Retrying documentation for {prepared['name']} individually")
+                output = self._write_doc(prepared, sdk_path)
+            outputs.append(output)
         return outputs
+
+    def _apply_doc(self, prepared: dict, output: dict) -> dict:
+        inputs = prepared["inputs"]
+        inputs.update(output) 
+        modified_code_file = self.tracer.run_step(ModifyCodePB, inputs, export=prepared["name"])
+        if self.docs_cache is not None:
+            self.docs_cache.store(prepared["name"], prepared["cache_key"], output["file_path"])
+        return modified_code_file
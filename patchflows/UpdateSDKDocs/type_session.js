@@ -0,0 +1,103 @@
+// Long lived type analysis session for UpdateSDKDocs.
+// Loads the TypeScript project once, then answers one JSON request per line on stdin:
+//   {"file_path": "/abs/path/file.tsx", "names": ["A", "B"]}
+// with one JSON response per line on stdout:
+//   {"type_information": {"A": {...}, "B": null}} or {"error": "..."}
+const fs = require("fs");
+const path = require("path");
+const readline = require("readline");
+
+const { Project, Node } = require(require.resolve("ts-morph", { paths: [process.cwd(), __dirname] }));
+
+const projectRoot = path.resolve(process.argv[2] || ".");
+
+function findTsConfig(directory) {
+  let current = directory;
+  while (true) {
+    const candidate = path.join(current, "tsconfig.json");
+    if (fs.existsSync(candidate)) {
+      return candidate;
+    }
+    const parent = path.dirname(current);
+    if (parent === current) {
+      return undefined;
+    }
+    current = parent;
+  }
+}
+
+function createProject() {
+  const tsConfigFilePath = findTsConfig(projectRoot);
+  if (tsConfigFilePath !== undefined) {
+    return new Project({ tsConfigFilePath });
+  }
+  const project = new Project({ compilerOptions: { allowJs: true, jsx: 4 /* react-jsx */ } });
+  project.addSourceFilesAtPaths(path.join(projectRoot, "**/*.{ts,tsx}"));
+  return project;
+}
+
+function findDeclaration(sourceFile, name) {
+  const exported = sourceFile.getExportedDeclarations().get(name);
+  if (exported !== undefined && exported.length > 0) {
+    return exported[0];
+  }
+  return sourceFile.getFunction(name) || sourceFile.getClass(name) || sourceFile.getVariableDeclaration(name);
+}
+
+function describeSymbol(symbol, location) {
+  return {
+    name: symbol.getName(),
+    type: symbol.getTypeAtLocation(location).getText(location),
+    isOptional: symbol.isOptional(),
+  };
+}
+
+function typeInformation(sourceFile, name) {
+  const declaration = findDeclaration(sourceFile, name);
+  if (declaration === undefined) {
+    return null;
+  }
+
+  const type = declaration.getType();
+  const information = {
+    kind: declaration.getKindName(),
+    name,
+    type: type.getText(declaration),
+  };
+
+  const signatures = type.getCallSignatures();
+  if (signatures.length > 0) {
+    information.signatures = signatures.map((signature) => ({
+      parameters: signature.getParameters().map((parameter) => describeSymbol(parameter, declaration)),
+      returnType: signature.getReturnType().getText(declaration),
+    }));
+  }
+
+  if (Node.isClassDeclaration(declaration)) {
+    information.members = type
+      .getProperties()
+      .filter((property) => !property.getName().startsWith("_"))
+      .map((property) => describeSymbol(property, declaration));
+  }
+
+  return information;
+}
+
+const project = createProject();
+const input = readline.createInterface({ input: process.stdin });
+
+input.on("line", (line) => {
+  let response;
+  try {
+    const request = JSON.parse(line);
+    const sourceFile = project.getSourceFile(request.file_path) || project.addSourceFileAtPath(request.file_path);
+    const result = {};
+    for (const name of request.names) {
+      result[name] = typeInformation(sourceFile, name);
+    }
+    response = { type_information: result };
+  } catch (error) {
+    response = { error: String(error) };
+  }
+  process.stdout.write(JSON.stringify(response) + "\n");
+});
@@ -0,0 +1,339 @@
+"""Content addressed disk cache of LLM responses, shared by the custom patchflows and a local caching proxy.
+
+The custom patchflows wrap their LLM steps with LLMCache.wrap. The built-in patchflows call the configured
+client_base_url, so they are cached by pointing it at the proxy:
+
+    python patchflows/_common/llm_cache.py run --upstream http://localhost:8000/v1 -- \
+        patchwork AutoFix --config patchflows
+
+`run` starts the proxy, passes its address to the command as client_base_url and prints the cache counters
+once the command exits. `serve` only starts the proxy.
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Optional
+
+from patchwork.logger import logger
+
+# Bump whenever the layout of an entry changes, older entries are then never hit again
+_CACHE_VERSION = "1"
+# Arguments that select a different completion but are not one of the named parts of the key
+_KEY_EXCLUDED_ARGS = {"model", "messages", "temperature", "top_p", "max_tokens", "stream", "user"}
+_EVICT_EVERY_STORES = 100
+
+
+def _canonical(value) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode()
+
+
+class LLMCache:
+    """Responses stored by the hash of the request, expired after a TTL and evicted least recently used first."""
+
+    def __init__(self, cache_dir: str, max_size_mb: int = 512, ttl_hours: Optional[float] = None):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.ttl = ttl_hours * 3600 if ttl_hours else None
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "evicted": 0, "tokens_saved": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_inputs(cls, inputs: dict) -> Optional["LLMCache"]:
+        if not inputs.get("llm_cache_dir"):
+            return None
+        ttl_hours = inputs.get("llm_cache_ttl_hours")
+        return cls(
+            inputs["llm_cache_dir"],
+            int(inputs.get("llm_cache_max_size_mb", 512)),
+            float(ttl_hours) if ttl_hours is not None else None,
+        )
+
+    @staticmethod
+    def key(model: str, client_base_url: Optional[str], temperature, top_p, max_tokens, messages: list,
+            **model_args) -> str:
+        parts = {
+            "version": _CACHE_VERSION,
+            "model": model,
+            "client_base_url": (client_base_url or "").rstrip("/"),
+            # Configs give numbers as strings on the command line, "0.2" and 0.2 select the same completion
+            "temperature": float(temperature) if temperature is not None else None,
+            "top_p": float(top_p) if top_p is not None else None,
+            "max_tokens": int(max_tokens) if max_tokens is not None else None,
+            "messages": messages,
+            "model_args": model_args,
+        }
+        return hashlib.sha256(_canonical(parts)).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            self._count("expired")
+            self._count("misses")
+            path.unlink(missing_ok=True)
+            return None
+        # The mtime marks the last use for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        self._count("tokens_saved", entry.get("tokens", 0))
+        return entry["value"]
+
+    def put(self, key: str, value, tokens: int = 0):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Readers in other threads and processes only ever see complete entries
+        tmp_file = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_file.write_text(json.dumps({"created": time.time(), "tokens": tokens, "value": value}, default=str))
+        os.replace(tmp_file, path)
+        self._count("stores")
+
+    def evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            total_size -= size
+            path.unlink(missing_ok=True)
+            self._count("evicted")
+
+    def wrap(self, step_class, is_valid: Optional[Callable[[object], bool]] = None):
+        """
+        Returns a drop-in for an LLM step such as SimplifiedLLMOnce that answers repeated requests from the cache.
+
+        Only answers whose extracted_response passes is_valid are stored, so a rerun asks again for the others.
+        """
+        cache = self
+
+        class _CachedStep:
+            def __init__(self, inputs: dict):
+                self.inputs = inputs
+
+            def run(self) -> dict:
+                key = cache.key_for_step(self.inputs)
+                outputs = cache.get(key)
+                if outputs is not None:
+                    return outputs
+                outputs = step_class(self.inputs).run()
+                if self._should_store(outputs):
+                    tokens = outputs.get("request_tokens", 0) + outputs.get("response_tokens", 0)
+                    cached = {k: v for k, v in outputs.items() if k not in ("request_tokens", "response_tokens")}
+                    cache.put(key, cached, tokens)
+                return outputs
+
+            def _should_store(self, outputs: dict) -> bool:
+                # Failed and truncated calls come back empty, they are retried on the next run
+                if not outputs.get("openai_response"):
+                    return False
+                extracted_response = outputs.get("extracted_response")
+                # JSON that does not parse is extracted as {}
+                if self.inputs.get("json", False) and not extracted_response:
+                    return False
+                return is_valid is None or is_valid(extracted_response)
+
+        _CachedStep.__name__ = step_class.__name__
+        return _CachedStep
+
+    def key_for_step(self, inputs: dict) -> str:
+        from patchwork.steps import PreparePrompt
+
+        # Rendered the same way SimplifiedLLM renders them before calling the model
+        prompts = [dict(role="user", content=inputs["prompt_user"])]
+        if inputs.get("prompt_system"):
+            prompts.insert(0, dict(role="system", content=inputs["prompt_system"]))
+        messages = PreparePrompt(
+            dict(prompt_template=prompts, prompt_values=[inputs["prompt_value"]])
+        ).run()["prompts"][0]
+        model_args = {
+            key[len("model_"):]: value
+            for key, value in inputs.items()
+            if key.startswith("model_") and key[len("model_"):] not in _KEY_EXCLUDED_ARGS
+        }
+        model_args["response_format"] = "json_object" if inputs.get("json", False) else "text"
+        return self.key(
+            inputs.get("model"),
+            inputs.get("client_base_url"),
+            inputs.get("model_temperature"),
+            inputs.get("model_top_p"),
+            inputs.get("model_max_tokens"),
+            messages,
+            **model_args,
+        )
+
+    def print_stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters["hits"] + counters["misses"]
+        hit_rate = counters["hits"] / lookups * 100 if lookups else 0
+        print(
+            f"\nLLM response cache: {counters['hits']} hits, {counters['misses']} misses ({hit_rate:.0f}% hit rate), "
+            f"{counters['expired']} expired, {counters['stores']} stored, {counters['evicted']} evicted, "
+            f"{counters['tokens_saved']} tokens saved, in {self.cache_dir}"
+        )
+
+
+class _CachingProxy:
+    """OpenAI compatible chat completions endpoint that forwards misses to the upstream endpoint."""
+
+    def __init__(self, cache: LLMCache, upstream: str, port: int = 0):
+        self.cache = cache
+        self.upstream = upstream.rstrip("/")
+        self._stores_since_evict = 0
+        self._evict_lock = threading.Lock()
+
+        proxy = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._forward(None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._forward(body)
+
+            def _forward(self, body: Optional[bytes]):
+                headers = {
+                    name: value for name, value in self.headers.items()
+                    if name.lower() in ("authorization", "content-type", "accept", "api-key")
+                }
+                status, data, cache_status = proxy.forward(self.path, body, headers)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("X-Cache", cache_status)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"LLM cache proxy: {format % args}")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self.cache.evict()
+
+    def _upstream_url(self, path: str) -> str:
+        # The clients send paths below the proxy's /v1, the upstream URL already ends with its own prefix
+        if path.startswith("/v1/"):
+            path = path[len("/v1"):]
+        return self.upstream + path
+
+    def forward(self, path: str, body: Optional[bytes], headers: dict) -> tuple:
+        key = None
+        if body is not None and path.rstrip("/").endswith("/chat/completions"):
+            request = json.loads(body or b"{}")
+            # Streamed completions are passed through untouched
+            if not request.get("stream"):
+                model_args = {k: v for k, v in request.items() if k not in _KEY_EXCLUDED_ARGS}
+                key = self.cache.key(
+                    request.get("model"), self.upstream, request.get("temperature"), request.get("top_p"),
+                    request.get("max_tokens"), request.get("messages"), **model_args
+                )
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return 200, json.dumps(cached).encode(), "HIT"
+
+        upstream_request = urllib.request.Request(
+            self._upstream_url(path), data=body, headers=headers, method="POST" if body is not None else "GET"
+        )
+        try:
+            with urllib.request.urlopen(upstream_request) as response:
+                status, data = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, data = e.code, e.read()
+        except urllib.error.URLError as e:
+            status, data = 502, json.dumps({"error": {"message": f"Upstream {self.upstream} failed: {e}"}}).encode()
+
+        if key is None:
+            return status, data, "BYPASS"
+        completion = json.loads(data) if status == 200 else None
+        choices = completion.get("choices") if isinstance(completion, dict) else None
+        # Truncated completions depend on allow_truncated in the caller, only complete answers are kept
+        if choices and choices[0].get("finish_reason") != "length":
+            usage = completion.get("usage") or {}
+            self.cache.put(key, completion, usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+            self._maybe_evict()
+        return status, data, "MISS"
+
+    def _maybe_evict(self):
+        with self._evict_lock:
+            self._stores_since_evict += 1
+            if self._stores_since_evict < _EVICT_EVERY_STORES:
+                return
+            self._stores_since_evict = 0
+        self.cache.evict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caching proxy in front of an OpenAI compatible endpoint")
+    parser.add_argument("mode", choices=["serve", "run"])
+    parser.add_argument("--upstream", default="http://localhost:8000/v1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--cache-dir", default=os.environ.get("PATCHFLOWS_LLM_CACHE_DIR", "~/.cache/patchwork/llm"))
+    parser.add_argument("--max-size-mb", type=int, default=512)
+    parser.add_argument("--ttl-hours", type=float, default=None)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    llm_cache = LLMCache(args.cache_dir, args.max_size_mb, args.ttl_hours)
+    caching_proxy = _CachingProxy(llm_cache, args.upstream, args.port)
+    caching_proxy.start()
+    exit_code = 0
+    try:
+        if args.mode == "serve":
+            print(f"Caching {args.upstream} at {caching_proxy.base_url}, set client_base_url to it")
+            while True:
+                time.sleep(3600)
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        if not command:
+            parser.error("run needs a command, for example: -- patchwork AutoFix --config patchflows")
+        # patchwork takes key=value options after the patchflow name, later ones win over the config file
+        exit_code = subprocess.run([*command, f"client_base_url={caching_proxy.base_url}"]).returncode
+    except KeyboardInterrupt:
+        pass
+    finally:
+        caching_proxy.stop()
+        llm_cache.print_stats()
+    sys.exit(exit_code)
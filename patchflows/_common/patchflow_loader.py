@@ -0,0 +1,191 @@
+"""Cached loading and validation of the config and prompt files of the custom patchflows.
+
+The patchflow modules are loaded by patchwork outside of sys.modules, so they reach this module through a
+sys.path entry instead. That keeps one instance, and with it one cache, per process for all patchflows.
+"""
+import copy
+import difflib
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+import yaml
+
+from patchwork.logger import logger
+
+# Options are documented in the config files as commented examples, those keys are known too
+_DOCUMENTED_KEY_PATTERN = re.compile(r"^#\s*([A-Za-z_][A-Za-z0-9_]*):", re.MULTILINE)
+# Mustache variables, sections and unescaped variables: {{name}}, {{#name}}, {{^name}}, {{&name}}, {{{name}}}
+_PLACEHOLDER_PATTERN = re.compile(r"\{\{\{?\s*[#^&]?\s*([A-Za-z_][\w.]*)\s*\}?\}\}")
+# Set to a folder to keep the compiled files across processes, for a faster CLI startup
+_DISK_CACHE_ENV = "PATCHFLOWS_CACHE_DIR"
+_COMPILER_VERSION = "1"
+
+_cache = {}
+_reported = set()
+_lock = threading.Lock()
+
+
+def _report_once(key: tuple, message: str):
+    with _lock:
+        if key in _reported:
+            return
+        _reported.add(key)
+    logger.warning(message)
+
+
+def _read_disk_cache(kind: str, text: str) -> tuple:
+    cache_dir = os.environ.get(_DISK_CACHE_ENV)
+    if not cache_dir:
+        return None, None
+    digest = hashlib.sha256(f"{_COMPILER_VERSION}\0{kind}\0{text}".encode()).hexdigest()
+    cache_file = Path(cache_dir).expanduser() / f"{digest}.json"
+    try:
+        return json.loads(cache_file.read_text()), cache_file
+    except (OSError, ValueError):
+        return None, cache_file
+
+
+def _write_disk_cache(cache_file: Path, compiled: dict):
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_file.write_text(json.dumps(compiled))
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f"Unable to write the compiled file cache {cache_file}: {e}")
+
+
+def _compiled(path, kind: str, compile_text: Callable[[str], dict]) -> dict:
+    path = Path(path).resolve()
+    stat = path.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        entry = _cache.get((kind, path))
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    text = path.read_text()
+    compiled, cache_file = _read_disk_cache(kind, text)
+    if compiled is None:
+        compiled = compile_text(text)
+        if cache_file is not None:
+            _write_disk_cache(cache_file, compiled)
+    for error in compiled["errors"]:
+        _report_once((path, stamp, error), f"{path}: {error}")
+
+    with _lock:
+        _cache[(kind, path)] = (stamp, compiled)
+    return compiled
+
+
+def _compile_config(text: str) -> dict:
+    try:
+        config = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        return {"config": {}, "known_keys": [], "errors": [f"invalid YAML, {e}"]}
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        return {"config": {}, "known_keys": [], "errors": ["expected a mapping of options"]}
+    known_keys = sorted(set(config) | set(_DOCUMENTED_KEY_PATTERN.findall(text)))
+    return {"config": config, "known_keys": known_keys, "errors": []}
+
+
+def _compile_prompts(text: str) -> dict:
+    # HelloWorld ships an empty prompt file as a placeholder
+    if not text.strip():
+        return {"prompts": {}, "errors": []}
+    try:
+        templates = json.loads(text)
+    except json.JSONDecodeError as e:
+        return {"prompts": {}, "errors": [f"invalid JSON, {e}"]}
+    if not isinstance(templates, list):
+        return {"prompts": {}, "errors": ["expected a list of prompt templates"]}
+
+    prompts = {}
+    errors = []
+    for index, template in enumerate(templates):
+        prompt_id = template.get("id") if isinstance(template, dict) else None
+        messages = template.get("prompts") if isinstance(template, dict) else None
+        if prompt_id is None or not isinstance(messages, list):
+            errors.append(f"prompt template {index} needs an `id` and a list of `prompts`")
+            continue
+        if prompt_id in prompts:
+            errors.append(f"PromptId[{prompt_id}] is defined more than once, the first one is used")
+            continue
+        placeholders = sorted({
+            placeholder
+            for message in messages
+            for value in message.values()
+            if isinstance(value, str)
+            for placeholder in _PLACEHOLDER_PATTERN.findall(value)
+        })
+        prompts[prompt_id] = {"prompts": messages, "placeholders": placeholders}
+    return {"prompts": prompts, "errors": errors}
+
+
+def load_config(config_file, inputs: dict) -> dict:
+    """Merges the inputs over a copy of the cached config file and reports input keys the config does not know."""
+    compiled = _compiled(config_file, "config", _compile_config)
+    known_keys = set(compiled["known_keys"])
+    for key in inputs:
+        if key in known_keys:
+            continue
+        close_matches = difflib.get_close_matches(key, known_keys, n=1)
+        hint = f", did you mean `{close_matches[0]}`?" if close_matches else ""
+        _report_once((Path(config_file).resolve(), key), f"Unknown option `{key}` for {Path(config_file).parent.name}{hint}")
+
+    final_inputs = copy.deepcopy(compiled["config"])
+    final_inputs.update(inputs)
+    return final_inputs
+
+
+def load_prompts(prompt_file, template_variables: Optional[dict] = None) -> dict:
+    """Returns the cached templates of a prompt file by id, each with its `prompts` and `placeholders`.
+
+    template_variables maps a prompt id to the names the patchflow fills in, placeholders outside of them are reported.
+    """
+    compiled = _compiled(prompt_file, "prompts", _compile_prompts)
+    prompt_file = Path(prompt_file).resolve()
+    for prompt_id, variables in (template_variables or {}).items():
+        prompt = compiled["prompts"].get(prompt_id)
+        if prompt is None:
+            _report_once((prompt_file, prompt_id), f"{prompt_file}: PromptId[{prompt_id}] is missing")
+            continue
+        for placeholder in prompt["placeholders"]:
+            # Dotted names and section variables resolve from the root name
+            if placeholder.split(".")[0] not in variables:
+                _report_once(
+                    (prompt_file, prompt_id, placeholder),
+                    f"{prompt_file}: PromptId[{prompt_id}] uses `{{{{{placeholder}}}}}` which is never filled in"
+                )
+    return compiled["prompts"]
+
+
+def compile_patchflows(patchflows_dir) -> dict:
+    """Compiles the config and prompt files of every patchflow in the folder into a registry by patchflow name."""
+    registry = {}
+    for folder in sorted(Path(patchflows_dir).iterdir()):
+        if not folder.is_dir() or folder.name.startswith(("_", ".")):
+            continue
+        entry = {}
+        for config_name in ("config.yml", "defaults.yml"):
+            if (folder / config_name).is_file():
+                entry["config"] = load_config(folder / config_name, {})
+        if (folder / "prompt.json").is_file():
+            entry["prompts"] = load_prompts(folder / "prompt.json")
+        registry[folder.name] = entry
+    return registry
+
+
+if __name__ == "__main__":
+    # Validates every patchflow and, with PATCHFLOWS_CACHE_DIR set, warms the on-disk cache
+    registry = compile_patchflows(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent)
+    for name, entry in registry.items():
+        print(f"{name}: {len(entry.get('config', {}))} options, {len(entry.get('prompts', {}))} prompts")
@@ -0,0 +1,147 @@
+"""Spans around the steps of the custom patchflows, written to a JSONL or Chrome trace file with a hot spot summary.
+
+Like patchflow_loader, this module is reached through a sys.path entry from the patchflow modules.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from tabulate import tabulate
+
+_TRACE_FORMATS = ("jsonl", "chrome")
+_SUMMARY_ROWS = 15
+
+
+def _token_count(value) -> int:
+    # SimplifiedLLMOnce reports one count, the list based steps report one count per prompt
+    if isinstance(value, (list, tuple)):
+        return sum(item for item in value if isinstance(item, int))
+    return value if isinstance(value, int) else 0
+
+
+class Tracer:
+    """Records spans when a trace file is given, every method is a cheap no-op otherwise."""
+
+    def __init__(self, trace_file: Optional[str] = None, trace_format: Optional[str] = None):
+        self.trace_file = Path(trace_file).expanduser() if trace_file else None
+        self.enabled = self.trace_file is not None
+        if trace_format is None:
+            trace_format = "chrome" if self.trace_file is not None and self.trace_file.suffix == ".json" else "jsonl"
+        if trace_format not in _TRACE_FORMATS:
+            raise ValueError(f"Unknown trace_format '{trace_format}', expected one of {list(_TRACE_FORMATS)}")
+        self.trace_format = trace_format
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_inputs(cls, inputs: dict) -> "Tracer":
+        return cls(inputs.get("trace_file"), inputs.get("trace_format"))
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the block, callers may add counters such as bytes_read to the yielded attributes."""
+        if not self.enabled:
+            yield attributes
+            return
+
+        start = time.time()
+        wall_start = time.perf_counter()
+        # CPU time of the calling thread, work done by child processes such as git is not included
+        cpu_start = time.thread_time()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span = {
+                "name": name,
+                "start": start,
+                "wall_s": time.perf_counter() - wall_start,
+                "cpu_s": time.thread_time() - cpu_start,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "attributes": attributes,
+            }
+            with self._lock:
+                self.spans.append(span)
+
+    def run_step(self, step_class, inputs: dict, name: Optional[str] = None, **attributes) -> dict:
+        with self.span(name or step_class.__name__, **attributes) as span_attributes:
+            outputs = step_class(inputs).run()
+            if self.enabled and isinstance(outputs, dict):
+                prompt_tokens = _token_count(outputs.get("request_tokens"))
+                completion_tokens = _token_count(outputs.get("response_tokens"))
+                if prompt_tokens or completion_tokens:
+                    span_attributes["prompt_tokens"] = prompt_tokens
+                    span_attributes["completion_tokens"] = completion_tokens
+                if isinstance(outputs.get("file_content"), str):
+                    span_attributes["bytes_read"] = len(outputs["file_content"].encode())
+        return outputs
+
+    def merge(self, spans_file: Path):
+        """Adds the spans a worker process saved as JSONL."""
+        if not self.enabled or not spans_file.is_file():
+            return
+        spans = [json.loads(line) for line in spans_file.read_text().splitlines() if line]
+        with self._lock:
+            self.spans.extend(spans)
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+        if self.trace_format == "jsonl":
+            self.trace_file.write_text("".join(json.dumps(span, default=str) + "\n" for span in spans))
+            return
+
+        # Complete events of the Chrome trace format, open the file in chrome://tracing or Perfetto
+        events = [
+            {
+                "name": span["name"],
+                "cat": "step",
+                "ph": "X",
+                "ts": int(span["start"] * 1_000_000),
+                "dur": int(span["wall_s"] * 1_000_000),
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": {**span["attributes"], "cpu_s": round(span["cpu_s"], 6)},
+            }
+            for span in spans
+        ]
+        self.trace_file.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str))
+
+    def print_summary(self):
+        if not self.enabled:
+            return
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span["name"], {
+                "span": span["name"], "calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "bytes_read": 0, "errors": 0,
+            })
+            attributes = span["attributes"]
+            total["calls"] += 1
+            total["wall_s"] += span["wall_s"]
+            total["cpu_s"] += span["cpu_s"]
+            total["prompt_tokens"] += attributes.get("prompt_tokens", 0)
+            total["completion_tokens"] += attributes.get("completion_tokens", 0)
+            total["bytes_read"] += attributes.get("bytes_read", 0)
+            total["errors"] += 1 if "error" in attributes else 0
+
+        rows = sorted(totals.values(), key=lambda total: total["wall_s"], reverse=True)[:_SUMMARY_ROWS]
+        for row in rows:
+            row["mean_ms"] = round(row["wall_s"] * 1000 / row["calls"], 1)
+            row["wall_s"] = round(row["wall_s"], 3)
+            row["cpu_s"] = round(row["cpu_s"], 3)
+        print("\nHot spots by total wall time, nested spans are included in their parents:")
+        print(tabulate(rows, headers="keys", tablefmt="grid"))
+        print(f"Trace with {len(spans)} spans written to {self.trace_file}")